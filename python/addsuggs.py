@@ -1,15 +1,23 @@
 #!/usr/bin/env python3.9
-import sys, pathlib
-from pprint import pprint
-deps_path = pathlib.Path(__file__).parent.absolute() / "deps.zip"
-sys.path.insert(0, str(deps_path))
+import sys
+from pprint import pformat
+import bootstrap
+bootstrap.setup()
 
-import json, base64
+import json
 import libcst as cst
 from typing import cast
 from libcst.metadata import PositionProvider, CodeRange
 
-from parse import ListUpdate, ValueUpdate, find_flow, NodeVisitor, DictUpdate
+from parse import ListUpdate, ValueUpdate, NodeVisitor, DictUpdate
+from cache import parse_cache
+from edits import text_edits
+from locate import cst_items, plot_size
+from metrics import count, measured, stage
+from framing import Body, dumps, serve_once, text_field
+from tracing import TRACE, get_logger, lazy
+
+log = get_logger("addsuggs")
 
 class CustomCondFinder(cst.CSTVisitor):
     METADATA_DEPENDENCIES = (PositionProvider,)
@@ -20,63 +28,91 @@ class CustomCondFinder(cst.CSTVisitor):
         self.tree = module
 
     def visit_Lambda(self, node: cst.Lambda) -> None:
-        sys.stderr.write('lambda:\n')
-        pprint(node, stream=sys.stderr)
-        sys.stderr.write(f'lambda code:\n{self.tree.code_for_node(node)}\n')
-        sys.stderr.write('\n')
+        log.log(TRACE, "lambda:\n%s", lazy(pformat, node))
+        log.debug("lambda code:\n%s\n", lazy(self.tree.code_for_node, node))
         if self.target_cnd == self.tree.code_for_node(node):
             pos = cast(CodeRange, self.get_metadata(PositionProvider, node)).start
             end = cast(CodeRange, self.get_metadata(PositionProvider, node)).end
             self.cond_pos = {"line": pos.line, "col": pos.column, "end": end.column}
 
 
-data = json.loads(sys.stdin.read())
-python_code: str = base64.b64decode(data["pyData"]).decode("utf-8")
-node_title = data["title"]
-sfc = data.get("sfc", "")
-flow = data["flow"]
-parent = data["parent"]
-cnd = data["cnd"]
-
-update_dict = {
-    flow: {
-        parent: {
-            "TRANSITIONS": {
-                node_title: cnd
+def addsuggs(python_code: str, flow: str, parent: str, node_title: str, cnd: str, sfc: str = ""):
+    """
+    Add a new node to the flow, connected to the parent node with the given condition
+    """
+    update_dict = {
+        flow: {
+            parent: {
+                "TRANSITIONS": {
+                    node_title: cnd
+                }
+            },
+            node_title: {
+                "TRANSITIONS": {},
+                "RESPONSE": "''",
             }
-        },
-        node_title: {
-            "TRANSITIONS": {},
-            "RESPONSE": "''",
         }
     }
-}
-if sfc != '':
-    update_dict[flow][node_title]["MISC"] = {}
-    update_dict[flow][node_title]["MISC"]['"speech_functions"'] = ListUpdate([ValueUpdate(sfc)], allow_extra=False)
-update = DictUpdate.from_dict(update_dict)
+    if sfc != '':
+        update_dict[flow][node_title]["MISC"] = {}
+        update_dict[flow][node_title]["MISC"]['"speech_functions"'] = ListUpdate([ValueUpdate(sfc)], allow_extra=False)
+    update = DictUpdate.from_dict(update_dict)
+
+    module, old_flow = parse_cache.flow(python_code)
+    ret = {}
+    if old_flow:
+        nodes, edges = plot_size(old_flow, cst_items)
+        count("nodes", nodes)
+        count("edges", edges)
+        log.debug("visit:")
+        with stage("visit"):
+            new_flow = cast(cst.Dict, old_flow.visit(NodeVisitor(update, module)))
+        with stage("codegen"):
+            new_ast = cast(cst.Module, module.deep_replace(old_flow, new_flow))
+            python_code = new_ast.code
+        if cnd == 'lambda ctx, actor, *args, **kwargs: True':
+            wrapper = cst.MetadataWrapper(new_ast)
+            finder = CustomCondFinder(cnd, new_ast)
+            wrapper.visit(finder)
+            assert finder.cond_pos is not None
+            ret['customCondPos'] = finder.cond_pos
+        if module.has_trailing_newline:
+            if not python_code.endswith(module.default_newline):
+                python_code += module.default_newline
+        else:
+            python_code = python_code.rstrip(module.default_newline)
+        if python_code == new_ast.code:
+            parse_cache.store(python_code, new_ast, new_flow)
+    ret['pycode'] = python_code
+    return ret
 
-module = cst.parse_module(python_code)
-old_flow = find_flow(module)
-ret = {}
-if old_flow:
-    sys.stderr.write('visit:\n')
-    new_flow = cast(cst.Dict, old_flow.visit(NodeVisitor(update, module)))
-    sys.stderr.write('\n')
-    new_ast = cast(cst.Module, module.deep_replace(old_flow, new_flow))
-    if cnd == 'lambda ctx, actor, *args, **kwargs: True':
-        wrapper = cst.MetadataWrapper(new_ast)
-        finder = CustomCondFinder(cnd, new_ast)
-        wrapper.visit(finder)
-        assert finder.cond_pos is not None
-        ret['customCondPos'] = finder.cond_pos
-    python_code = new_ast.code
-    if module.has_trailing_newline:
-        if not python_code.endswith(module.default_newline):
-            python_code += module.default_newline
+
+@measured
+def handle(data):
+    """
+    Serve one request (JSON: { 'pyData': base64, 'title', 'flow', 'parent', 'cnd', 'sfc', 'edits' })
+    and return the response. With 'edits' the new code is returned as a list of text edits
+    of the old code instead of the whole file.
+    """
+    python_code = text_field(data, "pyData")
+    ret = addsuggs(
+        python_code,
+        flow=data["flow"],
+        parent=data["parent"],
+        node_title=data["title"],
+        cnd=data["cnd"],
+        sfc=data.get("sfc", ""),
+    )
+    if data.get("edits"):
+        with stage("edits"):
+            ret['edits'] = text_edits(python_code, ret.pop('pycode'))
     else:
-        python_code = python_code.rstrip(module.default_newline)
+        ret['pycode'] = Body(ret['pycode'], b64=True)
+    return ret
+
 
-base64response = base64.b64encode(bytes(python_code, "utf-8")).decode("utf-8")
-ret['pycode'] = base64response
-sys.stdout.write(json.dumps(ret))
+if __name__ == "__main__":
+    if "--framed" in sys.argv[1:]:
+        serve_once(handle)
+    else:
+        sys.stdout.write(dumps(handle(json.loads(sys.stdin.read()))))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3.9
+# Time py2json on generated plots of growing size: the segment extraction
+# through SourceIndex against ast.get_source_segment() (per segment, the latter
+# is only timed on a sample as it splits the whole source on each call),
+# and the whole build.
+#
+#   python benchmarks/bench_py2json.py [--nodes 50 200 800] [--repeat 3]
+import sys, pathlib
+root = pathlib.Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(root))
+import bootstrap
+bootstrap.setup()
+
+import ast
+import json
+import argparse
+import time
+
+from typing import Callable, List
+
+import py2json
+from plots import generate_plot
+
+
+def best_time(fn: Callable[[], object], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def transition_nodes(tree: ast.Module) -> List[ast.AST]:
+    """
+    Keys and values of all the TRANSITIONS dicts, the nodes py2json takes segments of
+    """
+    found = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Dict):
+            for key, value in zip(node.keys, node.values):
+                if isinstance(key, ast.Name) and key.id == "TRANSITIONS" and isinstance(value, ast.Dict):
+                    found.extend(value.keys)
+                    found.extend(value.values)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--flows", type=int, default=4)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[50, 200, 800])
+    parser.add_argument("--transitions", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--sample", type=int, default=50)
+    args = parser.parse_args()
+
+    results = []
+    for nodes in args.nodes:
+        source = generate_plot(args.flows, nodes, args.transitions)
+        tree = ast.parse(source)
+        segments = transition_nodes(tree)
+
+        sample = segments[:args.sample]
+
+        def get_source_segment():
+            for node in sample:
+                ast.get_source_segment(source, node)
+
+        def source_index():
+            index = py2json.SourceIndex(source)
+            for node in segments:
+                index.segment(node)
+
+        def build():
+            py2json.graph2json(py2json.flow2graph(py2json.Flows(source, ast.parse(source))))
+
+        results.append({
+            "bytes": len(source),
+            "segments": len(segments),
+            "get_source_segment_us": best_time(get_source_segment, args.repeat) / len(sample) * 1e6,
+            "source_index_us": best_time(source_index, args.repeat) / len(segments) * 1e6,
+            "py2json_s": best_time(build, args.repeat),
+        })
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
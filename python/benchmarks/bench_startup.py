@@ -0,0 +1,109 @@
+#!/usr/bin/env python3.9
+# Time to the first response of a fresh server process, as the extension sees it:
+# from starting `server.py --framed` to reading the response to its first request.
+# Measured with the dependencies imported from deps.zip and from the extracted,
+# compiled copy (see bootstrap.py), for each action given. The caches live in a
+# temporary directory, the disk graph cache is off unless --disk-cache.
+#
+# Writes JSON: p50/p95/min (ms) per mode and action, and the time the server itself
+# measured (from the `startup` action).
+#
+#   python benchmarks/bench_startup.py [--actions py2json py2drawio] [--repeat 10]
+import sys, pathlib
+root = pathlib.Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(root))
+sys.path.insert(0, str(root / "benchmarks"))
+
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from typing import Any, Dict, List, Tuple
+
+from framing import Body, read_frame, write_frame
+from plots import generate_plot
+
+MODES = {"zip": "zip", "unpacked": ""}
+
+
+def first_response(env: Dict[str, str], action: str, payload: Dict[str, Any]) -> Tuple[float, Dict[str, Any]]:
+    """
+    Time to the first response (s) of a new server, and what it reports about its startup
+    """
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, str(root / "server.py"), "--framed"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+    )
+    try:
+        write_frame(server.stdin, {"id": 0, "action": action, "payload": payload})
+        response = read_frame(server.stdout)
+        elapsed = time.perf_counter() - start
+        if response is None or "error" in response:
+            raise RuntimeError(f"{action} failed: {response}")
+        write_frame(server.stdin, {"id": 1, "action": "startup", "payload": {}})
+        startup = read_frame(server.stdout)["payload"]
+        write_frame(server.stdin, {"action": "exit"})
+        server.wait(timeout=30)
+    finally:
+        if server.poll() is None:
+            server.kill()
+    return elapsed, startup
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--actions", nargs="+", default=["py2json", "py2drawio"])
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--flows", type=int, default=4)
+    parser.add_argument("--nodes", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--disk-cache", action="store_true", help="keep the disk graph cache on")
+    args = parser.parse_args()
+
+    source = generate_plot(args.flows, args.nodes, 3)
+    payload = {"pycode": Body(source)}
+    results = []
+    with tempfile.TemporaryDirectory() as cache_home:
+        for mode in args.modes:
+            env = {**os.environ, "XDG_CACHE_HOME": cache_home, "DD_IDDE_DEPS": MODES[mode]}
+            if not args.disk_cache:
+                env["DD_IDDE_CACHE_DIR"] = "off"
+            for action in args.actions:
+                # Extracts the dependencies and fills the disk cache, not measured
+                first_response(env, action, payload)
+                times = []
+                startup: Dict[str, Any] = {}
+                for _ in range(args.repeat):
+                    elapsed, startup = first_response(env, action, payload)
+                    times.append(elapsed)
+                results.append({
+                    "mode": mode,
+                    "action": action,
+                    "runs": len(times),
+                    "p50_ms": percentile(times, 50) * 1e3,
+                    "p95_ms": percentile(times, 95) * 1e3,
+                    "min_ms": min(times) * 1e3,
+                    # Measured by the server from its first import, without the interpreter start
+                    "server_ms": startup["first_response"]["ms"],
+                    "modules": startup["modules"],
+                })
+                print(f"{mode} {action}: {results[-1]['p50_ms']:.0f} ms", file=sys.stderr)
+    json.dump({
+        "meta": {"python": platform.python_version(), "platform": platform.platform(), "args": vars(args)},
+        "results": results,
+    }, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
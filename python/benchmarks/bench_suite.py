@@ -0,0 +1,172 @@
+#!/usr/bin/env python3.9
+# Time every conversion stage on generated plots of growing size: py2json,
+# py2drawio, drawio2py (applying the py2drawio document back to the source),
+# addsuggs and the layout. Each run starts cold: the parse cache and the layout
+# cache are cleared and the disk cache is off. Memoized condition titles are kept,
+# as they are in the server.
+#
+# Writes JSON: latency (p50/p95/mean, ms), throughput (plot nodes and source MB
+# per second at p50) and the peak memory traced during one more run, per stage and size.
+# With --compare the p50 and p95 ratios to an earlier report are added.
+#
+#   python benchmarks/bench_suite.py [--sizes 2x25 4x50 8x100] [--repeat 5] [--output report.json]
+import sys, pathlib
+root = pathlib.Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(root))
+import bootstrap
+bootstrap.setup()
+
+import os
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+from typing import Any, Callable, Dict, List, Tuple
+
+import py2json
+import py2drawio
+import drawio2py
+import addsuggs
+import graphviz
+from cache import parse_cache
+from plots import generate_plot
+
+Stage = Callable[[], object]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Nearest rank percentile
+    """
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+def cold():
+    parse_cache.entries.clear()
+    graphviz._layouts.clear()
+
+
+def run_stage(fn: Stage, repeat: int, warmup: int) -> Tuple[List[float], int]:
+    """
+    Wall times of `repeat` cold runs (s) and the peak of memory allocated during one more (bytes)
+    """
+    for _ in range(warmup):
+        cold()
+        fn()
+    times = []
+    for _ in range(repeat):
+        cold()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    cold()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+def stages(source: str) -> Dict[str, Stage]:
+    xml = py2drawio.pipeline(source)
+    graph = py2json.py2json(source)
+    return {
+        "py2json": lambda: py2json.py2json(source),
+        "py2drawio": lambda: py2drawio.pipeline(source),
+        "drawio2py": lambda: drawio2py.drawio2py(xml, source),
+        "addsuggs": lambda: addsuggs.addsuggs(
+            source, "flow_0", "node_0", "new_node", 'dm_cnd.is_sf("Open.Give.Opinion")', "Open.Give.Opinion"
+        ),
+        "layout": lambda: graphviz.layout_graph(graph),
+    }
+
+
+def parse_size(size: str) -> Tuple[int, int]:
+    flows, nodes = size.lower().split("x")
+    return int(flows), int(nodes)
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any]):
+    """
+    Add the ratios of p50 and p95 to the same stage and size of an earlier report
+    """
+    old = {(r["stage"], r["flows"], r["nodes"]): r for r in baseline["results"]}
+    for result in results:
+        before = old.get((result["stage"], result["flows"], result["nodes"]))
+        if before is not None and "p50_ms" in before and "p50_ms" in result:
+            result["p50_ratio"] = result["p50_ms"] / before["p50_ms"]
+            result["p95_ratio"] = result["p95_ms"] / before["p95_ms"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", default=["2x25", "4x50", "8x100"], help="flows x nodes per flow")
+    parser.add_argument("--transitions", type=int, default=3)
+    parser.add_argument("--depth", type=int, default=1, help="nesting depth of the conditions")
+    parser.add_argument("--speech-functions", type=int, default=1)
+    parser.add_argument("--stages", nargs="+", default=["py2json", "py2drawio", "drawio2py", "addsuggs", "layout"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the report to instead of stdout")
+    parser.add_argument("--compare", help="earlier report to compare with")
+    args = parser.parse_args()
+
+    # Only the work of this run is measured
+    parse_cache.configure(incremental=False, disk="off")
+
+    results = []
+    for size in args.sizes:
+        flows, nodes = parse_size(size)
+        source = generate_plot(flows, nodes, args.transitions, args.seed, args.depth, args.speech_functions)
+        plot_stages = stages(source)
+        for name in args.stages:
+            result: Dict[str, Any] = {
+                "stage": name, "flows": flows, "nodes": nodes, "plot_nodes": flows * nodes, "bytes": len(source),
+            }
+            try:
+                times, peak = run_stage(plot_stages[name], args.repeat, args.warmup)
+            except ImportError as e:
+                # The layout needs grandalf, which is optional
+                result["error"] = str(e)
+            else:
+                p50 = percentile(times, 50)
+                result.update({
+                    "runs": len(times),
+                    "p50_ms": p50 * 1e3,
+                    "p95_ms": percentile(times, 95) * 1e3,
+                    "mean_ms": sum(times) / len(times) * 1e3,
+                    "nodes_per_s": flows * nodes / p50,
+                    "mb_per_s": len(source) / p50 / 1e6,
+                    "peak_kb": peak / 1024,
+                })
+            print(f"{name} {size}: {result.get('p50_ms', result.get('error'))}", file=sys.stderr)
+            results.append(result)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+if __name__ == "__main__":
+    main()
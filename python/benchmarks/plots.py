@@ -0,0 +1,74 @@
+import random
+
+from typing import List
+
+HEADER = """from dff.core.keywords import TRANSITIONS, RESPONSE, MISC
+import dff.conditions as cnd
+import common.dff.integration.condition as int_cnd
+import common.dff.integration.response as int_rsp
+import dm_cnd
+
+
+"""
+
+
+# Speech functions listed in MISC, the first ones are used
+SPEECH_FUNCTIONS = [
+    "Open.Give.Opinion",
+    "React.Rejoinder.Support.Track.Clarify",
+    "Sustain.Continue.Prolong.Extend",
+    "React.Respond.Support.Reply.Agree",
+    "Open.Demand.Fact",
+]
+
+
+def condition(rng: random.Random, depth: int = 1) -> str:
+    """
+    A transition condition, conditions with `depth` > 1 combine `depth` - 1 deep ones
+    """
+    if depth > 1:
+        combine = rng.choice(["cnd.any", "cnd.all"])
+        args = ", ".join(condition(rng, depth - 1) for _ in range(rng.randrange(2, 4)))
+        return f"{combine}([{args}])"
+    kind = rng.randrange(4)
+    if kind == 0:
+        return 'dm_cnd.is_sf("Open.Give.Opinion")'
+    if kind == 1:
+        return f'cnd.regexp(r"\\b(word{rng.randrange(100)}|other)\\b")'
+    if kind == 2:
+        return "cnd.any([int_cnd.is_yes_vars, cnd.regexp(r\"yes\")])"
+    return "int_cnd.is_no_vars"
+
+
+def generate_plot(
+    flows: int,
+    nodes: int,
+    transitions: int,
+    seed: int = 0,
+    depth: int = 1,
+    speech_functions: int = 1,
+) -> str:
+    """
+    Source of a synthetic plot with `flows` flows of `nodes` nodes,
+    each with `transitions` transitions to random nodes of the same flow.
+    Conditions are nested `depth` levels deep, MISC lists `speech_functions` speech functions.
+    The same arguments always give the same source.
+    """
+    rng = random.Random(seed)
+    misc = ", ".join(f'"{sf}"' for sf in (SPEECH_FUNCTIONS * speech_functions)[:speech_functions])
+    lines: List[str] = [HEADER, "flows = {\n"]
+    for flow in range(flows):
+        lines.append(f'    "flow_{flow}": {{\n')
+        for node in range(nodes):
+            lines.append(f'        "node_{node}": {{\n')
+            lines.append("            RESPONSE: \"Response of node " + str(node) + " in flow " + str(flow) + "\",\n")
+            lines.append("            TRANSITIONS: {\n")
+            for target in rng.sample(range(nodes), min(transitions, nodes)):
+                lines.append(f'                "node_{target}": {condition(rng, depth)},\n')
+            lines.append("            },\n")
+            if speech_functions:
+                lines.append(f'            MISC: {{"speech_functions": [{misc}]}},\n')
+            lines.append("        },\n")
+        lines.append("    },\n")
+    lines.append("}\n")
+    return "".join(lines)
@@ -0,0 +1,120 @@
+# Puts the bundled dependencies (deps.zip) on sys.path, first thing every script does.
+#
+# Modules imported from a zip are compiled on every start and their bytecode is never
+# cached. So deps.zip is extracted once into a cache directory, versioned by the hash
+# of the zip and the interpreter, and compiled there. Later starts import the .pyc files.
+# With DD_IDDE_DEPS=zip, or if the cache directory cannot be written, deps.zip is used.
+import os
+import sys
+import time
+import hashlib
+import pathlib
+
+from typing import Optional
+
+# Process start as seen by the scripts, for the time to the first response
+started = time.perf_counter()
+
+DEPS_ZIP = pathlib.Path(__file__).parent.absolute() / "deps.zip"
+DEPS_ENV = "DD_IDDE_DEPS"
+# Extracted versions not used for this long (seconds) are deleted
+MAX_AGE = 30 * 24 * 3600
+
+# Where the dependencies are imported from, set by setup()
+deps_path: Optional[str] = None
+
+
+def cache_home() -> pathlib.Path:
+    """
+    Cache directory of the extension, every cache has its own directory in it
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return pathlib.Path(base) / "dd-idde"
+
+
+def cache_root() -> pathlib.Path:
+    return cache_home() / "deps"
+
+
+def deps_version() -> str:
+    """
+    Name of the directory deps.zip is extracted to: the interpreter (bytecode is
+    specific to it) and the hash of the zip
+    """
+    digest = hashlib.sha1(DEPS_ZIP.read_bytes()).hexdigest()[:12]
+    return f"{sys.implementation.cache_tag}-{digest}"
+
+
+def extract(target: pathlib.Path):
+    """
+    Extract and compile deps.zip into `target`. It is done in a temporary directory
+    which is then renamed, so a started extraction is never taken for a finished one.
+    """
+    import shutil
+    import tempfile
+    import zipfile
+    import compileall
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=target.parent, prefix=".tmp-")
+    try:
+        with zipfile.ZipFile(DEPS_ZIP) as deps:
+            deps.extractall(tmp)
+        # Tracebacks show the final paths
+        compileall.compile_dir(tmp, ddir=str(target), quiet=2)
+        try:
+            os.replace(tmp, target)
+        except OSError:
+            # Another process was faster
+            if not target.is_dir():
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    # Versions of the same interpreter extracted from other zips, unless they are still
+    # used (another installed version of the extension)
+    prefix = sys.implementation.cache_tag + "-"
+    now = time.time()
+    for old in target.parent.iterdir():
+        if not old.name.startswith(prefix) or old == target:
+            continue
+        try:
+            if now - old.stat().st_mtime > MAX_AGE:
+                shutil.rmtree(old, ignore_errors=True)
+        except OSError:
+            # Deleted by another process
+            pass
+
+
+def unpacked() -> Optional[pathlib.Path]:
+    """
+    The extracted dependencies, extracted now if needed, None if that fails
+    """
+    try:
+        target = cache_root() / deps_version()
+        if not target.is_dir():
+            extract(target)
+    except OSError as e:
+        sys.stderr.write(f"Using {DEPS_ZIP}, cannot extract it: {e}\n")
+        return None
+    try:
+        # Marks the version as used, see extract()
+        os.utime(target)
+    except OSError:
+        pass
+    return target
+
+
+def setup() -> str:
+    """
+    Put the dependencies on sys.path (once), returns where they are imported from
+    """
+    global deps_path
+    if deps_path is None:
+        path = unpacked() if os.environ.get(DEPS_ENV) != "zip" else None
+        deps_path = str(path or DEPS_ZIP)
+        sys.path.insert(0, deps_path)
+    return deps_path
+
+
+def elapsed_ms() -> float:
+    return (time.perf_counter() - started) * 1e3
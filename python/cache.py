@@ -0,0 +1,313 @@
+import ast
+import hashlib
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+from locate import locate_ast_flow
+from persist import DiskCache, default_dir, open_disk_cache
+from metrics import count, stage
+
+# libcst is only imported once a libcst tree is needed, py2json gets by with ast
+if TYPE_CHECKING:
+    import libcst as cst
+    from incremental import IncrementalParser
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+# Defaults for the cache shared by the conversion scripts
+DEFAULT_MAX_ENTRIES = 16
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Memory taken by the parsed trees, per character of the source. Measured with
+# tracemalloc on the test flows and generated plots (libcst 45-115, ast 23-58)
+CST_BYTES_PER_CHAR = 100
+AST_BYTES_PER_CHAR = 40
+
+
+def source_hash(source: str) -> str:
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+
+class LRUCache(Generic[K, V]):
+    """
+    Bounded mapping which evicts the least recently used items first.
+    Every item has a size (in bytes, as reported by the caller), the cache is
+    kept under both `max_entries` and `max_bytes`.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._items: "OrderedDict[K, Tuple[V, int]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key: K):
+        return key in self._items
+
+    def get(self, key: K) -> Optional[V]:
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key: K, value: V, size: int = 0):
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self._items[key] = (value, size)
+        self.size += size
+        self._evict()
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+    def resize(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._evict()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._items),
+            "bytes": self.size,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _evict(self):
+        # The most recently added item is always kept, even if it is over the limit alone
+        while len(self._items) > 1 and (
+            len(self._items) > self.max_entries
+            or (self.max_bytes is not None and self.size > self.max_bytes)
+        ):
+            _, (_, size) = self._items.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+
+@dataclass
+class ParsedSource:
+    """
+    Everything derived from one version of a source file
+    """
+    key: str
+    source_len: int
+    module: Optional["cst.Module"] = None
+    # find_flow() result, `False` when it was not looked up yet
+    flow: Any = False
+    tree: Optional[ast.Module] = None
+    # locate_ast_flow() result, `False` when it was not looked up yet
+    ast_flow: Any = False
+    # Graphs built from the source, keyed by the converter which built them
+    graphs: Dict[str, Any] = field(default_factory=dict)
+
+    def size(self) -> int:
+        """
+        Estimated memory of the entry (bytes): the source, the trees parsed from it and
+        the documents (strings) built from it. The JSON graphs are small next to the
+        trees and are not counted.
+        """
+        size = self.source_len
+        if self.module is not None:
+            size += self.source_len * CST_BYTES_PER_CHAR
+        if self.tree is not None:
+            size += self.source_len * AST_BYTES_PER_CHAR
+        for graph in self.graphs.values():
+            if isinstance(graph, (str, bytes)):
+                size += len(graph)
+        return size
+
+
+class ParseCache:
+    """
+    Parsed modules, located flows and derived graphs keyed by the hash of the source.
+
+    The size of an entry is an estimate of the memory taken by its source, the
+    trees parsed from it and the documents built from it (see ParsedSource.size),
+    `max_bytes` bounds it. The trees kept by the incremental parser are not counted.
+    In incremental mode, sources which are not in the cache are parsed by reusing
+    the tree of a similar earlier source (see incremental.py).
+    Graphs built with `persist` are also kept on disk (see persist.py), a source
+    seen by an earlier run of the server is then converted without parsing it.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: Optional[int] = DEFAULT_MAX_BYTES,
+        incremental: bool = True,
+        disk: Optional[str] = None,
+    ):
+        self.entries: LRUCache[str, ParsedSource] = LRUCache(max_entries, max_bytes)
+        self.use_incremental = incremental
+        # Created by the first libcst parse
+        self._incremental: Optional["IncrementalParser"] = None
+        # Directory of the disk cache, it is opened (which hashes the converter
+        # sources, see persist.py) by the first graph built with `persist`
+        self.disk_dir = disk
+        self._disk: Optional[DiskCache] = None
+        # Counted per requested artifact (module, flow, tree, graph)
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, source: str, key: Optional[str] = None) -> ParsedSource:
+        key = key or source_hash(source)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = ParsedSource(key, len(source))
+            self.entries.put(key, entry, entry.size())
+        return entry
+
+    def _grown(self, entry: ParsedSource):
+        """
+        Account for a tree or a document added to an entry
+        """
+        self.entries.put(entry.key, entry, entry.size())
+
+    @property
+    def incremental(self) -> Optional["IncrementalParser"]:
+        if self.use_incremental and self._incremental is None:
+            from incremental import IncrementalParser
+            self._incremental = IncrementalParser()
+        return self._incremental
+
+    @property
+    def disk(self) -> Optional[DiskCache]:
+        if self._disk is None and self.disk_dir is not None:
+            self._disk = open_disk_cache(self.disk_dir)
+        return self._disk
+
+    def module(self, source: str) -> "cst.Module":
+        return self._module(self.entry(source), source)
+
+    def flow(self, source: str) -> Tuple["cst.Module", Optional["cst.Dict"]]:
+        from parse import find_flow
+
+        entry = self.entry(source)
+        module = self._module(entry, source)
+        if self._miss(entry.flow is False):
+            with stage("find_flow"):
+                entry.flow = find_flow(module)
+        return module, entry.flow
+
+    def tree(self, source: str) -> ast.Module:
+        entry = self.entry(source)
+        if self._miss(entry.tree is None):
+            with stage("parse"):
+                entry.tree = ast.parse(source)
+            self._grown(entry)
+        return entry.tree
+
+    def ast_flow(self, source: str) -> Optional[ast.Assign]:
+        entry = self.entry(source)
+        tree = self.tree(source)
+        if self._miss(entry.ast_flow is False):
+            with stage("find_flow"):
+                entry.ast_flow = locate_ast_flow(tree)
+        return entry.ast_flow
+
+    def graph(self, source: str, kind: str, build: Callable[[], Any], persist: bool = False) -> Any:
+        """
+        The graph built by a converter, `build` is only called on a miss.
+        With `persist` the graph (JSON or a string) is also read from and written to the disk cache.
+        """
+        key = source_hash(source)
+        entry = self.entry(source, key)
+        if kind in entry.graphs:
+            self._miss(False)
+            return entry.graphs[kind]
+        disk = self.disk if persist else None
+        if disk is None:
+            graph = None
+        else:
+            with stage("disk"):
+                graph = disk.get(key, kind)
+        if self._miss(graph is None):
+            graph = build()
+            if disk is not None:
+                disk.put(key, kind, graph)
+        entry.graphs[kind] = graph
+        if isinstance(graph, (str, bytes)):
+            self._grown(entry)
+        return graph
+
+    def store(self, source: str, module: "cst.Module", flow: Any = False):
+        """
+        Remember the module a transform produced, so the source it generated is not parsed again
+        """
+        from parse import find_flow
+        entry = self.entry(source)
+        entry.module = module
+        self._grown(entry)
+        entry.flow = flow
+        if self.incremental is not None:
+            self.incremental.remember(source, module, find_flow(module) if flow is False else flow)
+
+    def configure(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        incremental: Optional[bool] = None,
+        disk: Optional[str] = None,
+    ):
+        """
+        `disk` is the directory of the disk cache, "off" disables it
+        """
+        self.entries.resize(max_entries, max_bytes)
+        if disk is not None:
+            self.disk_dir = None if disk == "off" else disk
+            self._disk = None
+        if incremental is not None and incremental != self.use_incremental:
+            self.use_incremental = incremental
+            self._incremental = None
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {**self.entries.stats(), "hits": self.hits, "misses": self.misses}
+        if self._incremental is not None:
+            stats["incremental"] = self._incremental.stats()
+        if self._disk is not None:
+            stats["disk"] = self._disk.stats()
+        return stats
+
+    def _module(self, entry: ParsedSource, source: str) -> "cst.Module":
+        if self._miss(entry.module is None):
+            with stage("parse"):
+                incremental = self.incremental
+                if incremental is not None:
+                    entry.module, entry.flow = incremental.parse(source)
+                else:
+                    import libcst as cst
+                    entry.module = cst.parse_module(source)
+            self._grown(entry)
+        return entry.module
+
+    def _miss(self, missing: bool) -> bool:
+        """
+        Count the lookup, returns whether the artifact has to be built
+        """
+        if missing:
+            self.misses += 1
+        else:
+            self.hits += 1
+        count("cache_misses" if missing else "cache_hits")
+        return missing
+
+
+parse_cache = ParseCache(disk=default_dir())
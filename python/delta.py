@@ -0,0 +1,111 @@
+import json
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from cache import LRUCache
+
+# Sessions (one per open graph editor) remembered by the server
+MAX_SESSIONS = 32
+
+Graph = Dict[str, List[Dict[str, Any]]]
+
+
+def element_id(parts: Tuple[str, ...]) -> str:
+    return json.dumps(parts)
+
+
+def keyed_graph(graph: Graph) -> Graph:
+    """
+    The py2json graph with stable ids instead of list indices.
+    A response node is identified by its flow and name, a condition node
+    by the response nodes it connects (there is one transition per target).
+    """
+    nodes = graph["nodes"]
+    # ("node", flow, name) and ("cnd", source flow, source name, target flow, target name)
+    parts: List[Tuple[str, ...]] = [
+        ("node", node["data"]["flow"], node["data"]["label"]) if node.get("type") == "response" else ()
+        for node in nodes
+    ]
+    sources: Dict[int, int] = {}
+    targets: Dict[int, int] = {}
+    for edge in graph["edges"]:
+        if parts[edge["source"]]:
+            sources[edge["target"]] = edge["source"]
+        else:
+            targets[edge["source"]] = edge["target"]
+    for idx, node_parts in enumerate(parts):
+        if not node_parts:
+            parts[idx] = ("cnd", *parts[sources[idx]][1:], *parts[targets[idx]][1:])
+    ids = [element_id(node_parts) for node_parts in parts]
+
+    return {
+        "nodes": [{**node, "id": node_id} for node, node_id in zip(nodes, ids)],
+        "edges": [
+            {
+                "id": element_id(("edge", *parts[edge["source"]], *parts[edge["target"]])),
+                "source": ids[edge["source"]],
+                "target": ids[edge["target"]],
+            }
+            for edge in graph["edges"]
+        ],
+    }
+
+
+def graph_delta(old: Graph, new: Graph) -> Optional[Dict[str, Any]]:
+    """
+    Nodes and edges added, removed and modified between two keyed graphs, None if they are the same
+    """
+    delta: Dict[str, Any] = {}
+    for kind in ("nodes", "edges"):
+        old_items = {item["id"]: item for item in old[kind]}
+        new_items = {item["id"]: item for item in new[kind]}
+        added = [item for item_id, item in new_items.items() if item_id not in old_items]
+        removed = [item_id for item_id in old_items if item_id not in new_items]
+        modified = [
+            item for item_id, item in new_items.items()
+            if item_id in old_items and old_items[item_id] != item
+        ]
+        if added or removed or modified:
+            delta[kind] = {"added": added, "removed": removed, "modified": modified}
+    return delta or None
+
+
+@dataclass
+class SessionState:
+    version: int
+    # The graph as built by py2json, to skip the diff when the cached graph is reused
+    graph: Graph
+    keyed: Graph
+
+
+class GraphSessions:
+    """
+    The last graph sent to each session, so the next one can be sent as a delta.
+
+    The client passes the version of the graph it has. If it matches the one
+    sent last, the response is a delta (or `unchanged`), otherwise the full graph.
+    """
+
+    def __init__(self, max_sessions: int = MAX_SESSIONS):
+        self.sessions: LRUCache[str, SessionState] = LRUCache(max_sessions)
+
+    def update(self, session: str, version: Optional[int], graph: Graph) -> Dict[str, Any]:
+        state = self.sessions.get(session)
+        if state is not None and version == state.version:
+            if state.graph is graph:
+                return {"version": version, "unchanged": True}
+            keyed = keyed_graph(graph)
+            delta = graph_delta(state.keyed, keyed)
+            self.sessions.put(session, SessionState(version if delta is None else version + 1, graph, keyed))
+            if delta is None:
+                return {"version": version, "unchanged": True}
+            return {"version": version + 1, "delta": delta}
+
+        keyed = keyed_graph(graph)
+        version = 1 if state is None else state.version + 1
+        self.sessions.put(session, SessionState(version, graph, keyed))
+        return {"version": version, "graph": keyed}
+
+
+graph_sessions = GraphSessions()
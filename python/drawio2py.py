@@ -1,16 +1,22 @@
 #!/usr/bin/env python3.9
-import sys, pathlib
-deps_path = pathlib.Path(__file__).parent.absolute() / "deps.zip"
-sys.path.insert(0, str(deps_path))
+import sys
+import bootstrap
+bootstrap.setup()
 
-import base64
 import json
 import libcst as cst
 from lxml import etree
-from collections import defaultdict
-from typing import Dict, Union, cast
+from collections import defaultdict, deque
+from typing import Dict, Tuple, Union, cast
 
-from parse import KeyUpdate, ListUpdate, ValueUpdate, find_flow, NodeVisitor, DictUpdate
+from parse import KeyUpdate, ListUpdate, ValueUpdate, NodeVisitor, DictUpdate
+from cache import parse_cache
+from edits import text_edits
+from metrics import count, measured, stage
+from framing import Body, dumps, serve_once, text_field
+from tracing import TRACE, get_logger, lazy
+
+log = get_logger("drawio2py")
 
 def unesc(s: str):
     return s.replace("&amp;", "&") \
@@ -18,19 +24,37 @@ def unesc(s: str):
         .replace("&gt;", ">") \
         .replace("&quot;", "\"")
 
+def index_cells(doc) -> Tuple[Dict[str, etree._Element], Dict[str, etree._Element]]:
+    """
+    Map ids and edge sources to the first element (in document order) that has them,
+    like `//*[@id=...]` and `//*[@source=...]` lookups, in a single pass
+    """
+    by_id: Dict[str, etree._Element] = {}
+    by_source: Dict[str, etree._Element] = {}
+    for elem in doc.iter(etree.Element):
+        elem_id = elem.get('id')
+        if elem_id is not None and elem_id not in by_id:
+            by_id[elem_id] = elem
+        source = elem.get('source')
+        if source is not None and source not in by_source:
+            by_source[source] = elem
+    return by_id, by_source
+
+
 def parse_file(drawio_fn):
-    sys.stderr.write(f"{drawio_fn}\n\n")
+    log.log(TRACE, "%s\n", drawio_fn)
     doc = etree.fromstring(drawio_fn)
     elems = doc.xpath("//root")[0].getchildren()
+    by_id, by_source = index_cells(doc)
     nodes = {}
     edge_flows = {}
     edges = defaultdict(dict)
 
     for node in elems:
         if 'isnode' in node.attrib:
-            usr_obj = doc.xpath(f"//*[@id='{node.attrib['parent']}']")
-            if len(usr_obj) > 0 and 'data_from_form' in usr_obj[0].attrib:
-                form_data = json.loads(unesc(usr_obj[0].attrib['data_from_form']))
+            usr_obj = by_id.get(node.attrib['parent'])
+            if usr_obj is not None and 'data_from_form' in usr_obj.attrib:
+                form_data = json.loads(unesc(usr_obj.attrib['data_from_form']))
             else:
                 form_data = {}
             title = form_data.get('node_title', node.attrib['label'])
@@ -42,7 +66,7 @@ def parse_file(drawio_fn):
             if 'node_title' not in form_data:
                 form_data['node_title'] = title
             nodeid = int(node.attrib['parent'])
-            sys.stderr.write(f'NODE: {old_title}: #{nodeid}\n')
+            log.debug("NODE: %s: #%s", old_title, nodeid)
             nodes[nodeid] = {
                 "old_title": old_title,
                 "title": title,
@@ -51,9 +75,13 @@ def parse_file(drawio_fn):
             }
         elif 'isedge' in node.attrib:
             try:
-                sys.stderr.write(f"target: " + str(doc.xpath(f"//*[@source='{int(node.attrib['target'])}']")[0].attrib) + '\n')
-                realtarget = doc.xpath(f"//*[@source='{int(node.attrib['target'])}']")[0].attrib['target']
-                sys.stderr.write(f'EDGE: {node} {int(node.attrib["source"])} -> {int(realtarget)} : {unesc(node.attrib["reallabel"])}\n')
+                realtarget_cell = by_source[str(int(node.attrib['target']))]
+                log.debug("target: %s", realtarget_cell.attrib)
+                realtarget = realtarget_cell.attrib['target']
+                log.debug(
+                    "EDGE: %s %s -> %s : %s",
+                    node, int(node.attrib["source"]), int(realtarget), lazy(unesc, node.attrib["reallabel"])
+                )
                 edges[int(node.attrib["source"])][ int(realtarget) ] = unesc(node.attrib['reallabel'])
             except Exception:
                 pass
@@ -61,9 +89,10 @@ def parse_file(drawio_fn):
 
 
 def get_updated_nodes(nodes, edges):
-    sys.stderr.write(f"nodes: {nodes}")
+    log.log(TRACE, "nodes: %s", nodes)
     updated = defaultdict(dict)
-    renames = {}
+    # (flow, new title) -> old title of the nodes renamed in the diagram
+    old_titles: Dict[Tuple[str, str], str] = {}
     valid_node_names = defaultdict(set)
     for node_dict in nodes.values():
         node = node_dict["node"]
@@ -73,7 +102,7 @@ def get_updated_nodes(nodes, edges):
         old_title = node_dict['old_title']
         node_name = node_dict['title']
         if old_title != node_name:
-            renames[old_title] = node_name
+            old_titles[(flow_name, node_name)] = old_title
         sfc = from_form.get("sfc", "")
 
         node_key = KeyUpdate(old_key=old_title, new_key=node_name)
@@ -93,33 +122,38 @@ def get_updated_nodes(nodes, edges):
         old_title = node_dict['old_title']
         node_name = node_dict['title']
         transitions: Dict[Union[str, KeyUpdate], Union[str, ValueUpdate]] = {}
-        sys.stderr.write(f"EDGES for {old_title}:\n{edges[int(node.attrib['parent'])]}\n")
+        log.debug("EDGES for %s:\n%s", old_title, edges[int(node.attrib['parent'])])
         for edge, edge_title in edges[int(node.attrib["parent"])].items():
-            sys.stderr.write(f"node#{edge} found: {edge in nodes}\n")
+            log.debug("node#%s found: %s", edge, edge in nodes)
             if edge not in nodes: continue
             target_data = nodes[edge]["form_data"]
-            sys.stderr.write(f"node: {node_name}, flow name {node.attrib['flow']}, target flow {nodes[edge]['node'].attrib['flow']}\n")
+            log.debug(
+                "node: %s, flow name %s, target flow %s",
+                node_name, node.attrib['flow'], nodes[edge]['node'].attrib['flow']
+            )
             if unesc(node.attrib["flow"]) != unesc(nodes[edge]["node"].attrib["flow"]):
                 target_flow = unesc(nodes[edge]['node'].attrib['flow'])
                 new_target_node = target_data['node_title']
-                old_target_node = next((o for o, n in renames.items() if n == new_target_node), new_target_node)
-                sys.stderr.write(f"flow name {target_flow}, node name (new) {new_target_node}, (old) {old_target_node}\n")
+                old_target_node = old_titles.get((target_flow, new_target_node), new_target_node)
+                log.debug("flow name %s, node name (new) %s, (old) %s", target_flow, new_target_node, old_target_node)
                 old_name = f"({target_flow}, {old_target_node})"
                 new_name = f"({target_flow}, {new_target_node})"
                 val = edge_title
                 transitions[KeyUpdate(old_key=old_name, new_key=new_name)] = val
                 if old_target_node != new_target_node:
-                    sys.stderr.write(f"trans {old_title} -> {old_name}={new_name}\n")
+                    log.debug("trans %s -> %s=%s", old_title, old_name, new_name)
             else:
-                new_name = target_data["node_title"] 
-                old_name = next((o for o, n in renames.items() if n == new_name), new_name) 
+                new_name = target_data["node_title"]
+                old_name = old_titles.get((flow_name, new_name), new_name)
                 val = edge_title
                 transitions[KeyUpdate(old_key=old_name, new_key=new_name)] = val
                 if new_name != old_name:
-                    sys.stderr.write(f"trans {old_title} -> {old_name}={new_name}\n")
-        sys.stderr.write(f"TRANSITIONS for {old_title}:\n{transitions}\n\n")
+                    log.debug("trans %s -> %s=%s", old_title, old_name, new_name)
+        log.debug("TRANSITIONS for %s:\n%s\n", old_title, transitions)
         transitions_upd = DictUpdate.from_dict(transitions)
         transitions_upd.allow_extra = False
+        # Terminal nodes are left without transitions
+        transitions_upd.add_empty = False
         updated[flow_name][old_title]['TRANSITIONS'] = transitions_upd
 
 
@@ -131,49 +165,87 @@ def get_updated_nodes(nodes, edges):
 
 
 def fix_missing_flows(nodes, edges, edge_flows):
-    for node_dict in nodes.values():
+    """
+    Give the nodes without a flow attribute the flow of a node with a transition to them,
+    following chains of such nodes. `nodes` and `edges` are keyed by the same node ids.
+    """
+    flows = {}
+    queue = deque()
+    for node_id, node_dict in nodes.items():
+        flow = node_dict["node"].attrib.get("flow")
+        if flow is not None:
+            flows[node_id] = flow
+            queue.append(node_id)
+    if len(flows) == len(nodes):
+        return nodes, edges
+
+    # Breadth first from the nodes which have a flow, so a node gets the flow of its closest source
+    while queue:
+        source = queue.popleft()
+        for target in edges.get(source, ()):
+            if target in nodes and target not in flows:
+                flows[target] = flows[source]
+                nodes[target]["node"].attrib["flow"] = flows[source]
+                queue.append(target)
+
+    for node_id, node_dict in nodes.items():
         node = node_dict["node"]
-        try:
-            node.attrib["flow"]
-        except KeyError:
-            i = int(node.attrib["id"])
-            for source, target in edges.items():
-                if i in edge_flows:
-                    node.attrib["flow"] = edge_flows[i]
-                try:  # If we find missing flow, check flow of parent node
-                    target[int(node.attrib["id"])]
-                    node.attrib["flow"] = nodes[source]["node"].attrib["flow"]
-                except KeyError:
-                    continue
+        if node_id not in flows and int(node.attrib["id"]) in edge_flows:
+            node.attrib["flow"] = edge_flows[int(node.attrib["id"])]
     return nodes, edges
 
 
 def parse_xml(content):
     nodes, edges, edge_flows = parse_file(content)
     nodes, edges = fix_missing_flows(nodes, edges, edge_flows)
+    count("nodes", len(nodes))
+    count("edges", sum(len(targets) for targets in edges.values()))
     updated = get_updated_nodes(nodes, edges)
     return updated
 
 
-# Receiving data from Extension (JSON: { 'xmlData': ..., 'pyData': .... })
-data = json.loads(sys.stdin.read())
-python_code: str = data["pyData"]
-
-updated, valid_node_names = parse_xml(data["xmlData"])
-module = cst.parse_module(python_code)
-old_flow = find_flow(module)
-if old_flow:
-    new_flow = cast(cst.Dict, old_flow.visit(NodeVisitor(updated, module)))
-    # assert False
-    python_code = cast(cst.Module, module.deep_replace(old_flow, new_flow)).code
-    if module.has_trailing_newline:
-        if not python_code.endswith(module.default_newline):
-            python_code += module.default_newline
+def drawio2py(xml_data, python_code):
+    """
+    Apply the changes made in the diagram to the python code
+    """
+    with stage("parse_xml"):
+        updated, valid_node_names = parse_xml(xml_data)
+    module, old_flow = parse_cache.flow(python_code)
+    if old_flow:
+        with stage("visit"):
+            new_flow = cast(cst.Dict, old_flow.visit(NodeVisitor(updated, module)))
+        # assert False
+        with stage("codegen"):
+            new_ast = cast(cst.Module, module.deep_replace(old_flow, new_flow))
+            python_code = new_ast.code
+        if module.has_trailing_newline:
+            if not python_code.endswith(module.default_newline):
+                python_code += module.default_newline
+        else:
+            python_code = python_code.rstrip(module.default_newline)
+        if python_code == new_ast.code:
+            parse_cache.store(python_code, new_ast, new_flow)
+        # sys.stdout.write(module.code_for_node(new_flow))
+    return python_code
+
+
+@measured
+def handle(data):
+    """
+    Serve one request (JSON: { 'xmlData': ..., 'pyData': ...., 'edits': ... }) and return the response.
+    With 'edits' the new code is returned as a list of text edits of 'pyData'.
+    """
+    old_code = text_field(data, "pyData", b64=False)
+    python_code = drawio2py(text_field(data, "xmlData", b64=False), old_code)
+    if data.get("edits"):
+        with stage("edits"):
+            return {"edits": text_edits(old_code, python_code)}
+    return {"pyCode": Body(python_code, b64=True)}
+
+
+if __name__ == "__main__":
+    if "--framed" in sys.argv[1:]:
+        serve_once(handle)
     else:
-        python_code = python_code.rstrip(module.default_newline)
-    # sys.stdout.write(module.code_for_node(new_flow))
-
-base64response = base64.b64encode(bytes(python_code, "utf-8")).decode("utf-8")
-response = json.dumps({"pyCode": base64response})
-sys.stdout.write(response)
-
+        # Receiving data from Extension (JSON: { 'xmlData': ..., 'pyData': .... })
+        sys.stdout.write(dumps(handle(json.loads(sys.stdin.read()))))
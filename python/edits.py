@@ -0,0 +1,64 @@
+import re
+import difflib
+
+from typing import Any, Dict, List
+
+from incremental import changed_span
+
+LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+TextEdit = Dict[str, Any]
+
+
+def split_lines(text: str) -> List[str]:
+    """
+    Split into lines (keeping the line breaks) the way the editor does
+    """
+    lines, start = [], 0
+    for match in LINE_BREAK.finditer(text):
+        lines.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        lines.append(text[start:])
+    return lines
+
+
+def utf16_len(text: str) -> int:
+    # Editor positions count UTF-16 code units
+    return len(text.encode("utf-16-le")) // 2
+
+
+def text_edits(old: str, new: str) -> List[TextEdit]:
+    """
+    Minimal list of line edits turning `old` into `new`
+    (JSON: [{ 'range': { 'start': { 'line', 'character' }, 'end': ... }, 'newText' }]).
+    Ranges refer to `old` and do not overlap, like the edits of a vscode WorkspaceEdit.
+    """
+    if old == new:
+        return []
+    # Transforms only change the flow, narrow the diff down to the changed lines
+    start, old_end, new_end = changed_span(old, new)
+    if start > 0 and old[start - 1] == "\r":
+        # The common "\r" may end a line in one string and start a "\r\n" in the other
+        start -= 1
+    line_start = max(old.rfind("\n", 0, start), old.rfind("\r", 0, start)) + 1
+    first_line = len(LINE_BREAK.findall(old, 0, line_start))
+    old_break = LINE_BREAK.search(old, old_end)
+    new_break = LINE_BREAK.search(new, new_end)
+    old_lines = split_lines(old[line_start:old_break.end() if old_break else len(old)])
+    new_lines = split_lines(new[line_start:new_break.end() if new_break else len(new)])
+
+    edits = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        end = {"line": first_line + i2, "character": 0}
+        if i2 > i1 and not LINE_BREAK.search(old_lines[i2 - 1]):
+            # The last line of the file has no line break to end the range on
+            end = {"line": first_line + i2 - 1, "character": utf16_len(old_lines[i2 - 1])}
+        edits.append({
+            "range": {"start": {"line": first_line + i1, "character": 0}, "end": end},
+            "newText": "".join(new_lines[j1:j2]),
+        })
+    return edits
@@ -0,0 +1,182 @@
+import sys
+import json
+import struct
+import base64
+
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from metrics import Metrics, clocks
+
+# Binary transport of requests and responses, used instead of JSON lines with `--framed`.
+#
+# A frame is the length of the header (4 bytes, big endian), the header (UTF-8 JSON:
+# the message with { 'id', 'action', 'payload', 'metrics'? } and 'body': [[field, byte length], ...])
+# and the body: the raw UTF-8 text of the listed payload fields, one after another.
+# Large text fields (source code, xml) travel in the body instead of base64 in JSON.
+
+PREFIX = struct.Struct(">I")
+
+class Body:
+    """
+    Text field of a response: raw in the body of a frame, a JSON string
+    (base64 encoded if `b64`, like the one-off scripts always returned it) otherwise.
+    The text can be an iterable of chunks, a frame then encodes them one by one
+    and the whole text is never built. It can only be written once.
+    """
+    __slots__ = ("text", "b64")
+
+    def __init__(self, text: Union[str, Iterable[str]], b64: bool = False):
+        self.text = text
+        self.b64 = b64
+
+    def chunks(self) -> Iterable[str]:
+        return (self.text,) if isinstance(self.text, str) else self.text
+
+    def to_json(self) -> str:
+        text = "".join(self.chunks())
+        if self.b64:
+            return base64.b64encode(text.encode("utf-8")).decode("utf-8")
+        return text
+
+
+def text_field(data: Dict[str, Any], name: str, b64: bool = True) -> str:
+    """
+    Text field of a request: raw bytes from the body of a frame,
+    or a JSON string (base64 encoded if `b64`)
+    """
+    value = data[name]
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return str(value, "utf-8")
+    if b64:
+        return base64.b64decode(value).decode("utf-8")
+    return value
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (Body, Metrics)):
+        return value.to_json()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(message: Any) -> str:
+    """
+    json.dumps() which encodes Body fields as JSON strings, and Metrics
+    """
+    return json.dumps(message, default=_default)
+
+
+def take_metrics(message: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[Metrics]]:
+    """
+    A response without the metrics of its payload (see metrics.py), and the metrics.
+    They are encoded after the rest of the response, with the time that took
+    (the 'serialize' stage), and sent next to the payload.
+    """
+    payload = message.get("payload")
+    if not isinstance(payload, dict) or not isinstance(payload.get("metrics"), Metrics):
+        return message, None
+    payload = dict(payload)
+    metrics = payload.pop("metrics")
+    return {**message, "payload": payload}, metrics
+
+
+def _metrics_field(metrics: Metrics) -> str:
+    # Closes the encoded message, whose closing brace it replaces
+    return f',"metrics":{dumps(metrics)}}}'
+
+
+def dumps_response(message: Dict[str, Any]) -> str:
+    """
+    dumps() of a response, with its metrics next to the payload (see take_metrics())
+    """
+    message, metrics = take_metrics(message)
+    if metrics is None:
+        return dumps(message)
+    start = clocks()
+    text = dumps(message)
+    metrics.add_since("serialize", start)
+    return text[:-1] + _metrics_field(metrics)
+
+
+def _read_exactly(stream: BinaryIO, size: int) -> Optional[bytearray]:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    read = 0
+    while read < size:
+        n = stream.readinto(view[read:])
+        if not n:
+            if read == 0:
+                return None
+            raise EOFError(f"Frame truncated after {read} of {size} bytes")
+        read += n
+    return buf
+
+
+def read_frame(stream: BinaryIO) -> Optional[Dict[str, Any]]:
+    """
+    Read one frame, None at the end of the stream. The body fields are put into
+    the payload as memoryviews of a single buffer, use text_field() to decode them.
+    """
+    prefix = _read_exactly(stream, PREFIX.size)
+    if prefix is None:
+        return None
+    (header_len,) = PREFIX.unpack(prefix)
+    header = _read_exactly(stream, header_len)
+    if header is None:
+        raise EOFError("Frame truncated before the header")
+    message = json.loads(header.decode("utf-8"))
+    fields: List[Tuple[str, int]] = message.pop("body", [])
+    body_len = sum(size for _, size in fields)
+    body = _read_exactly(stream, body_len) if body_len else bytearray()
+    if body is None:
+        raise EOFError("Frame truncated before the body")
+    view = memoryview(body)
+    payload = message.setdefault("payload", {})
+    offset = 0
+    for name, size in fields:
+        payload[name] = view[offset:offset + size]
+        offset += size
+    return message
+
+
+def write_frame(stream: BinaryIO, message: Dict[str, Any]):
+    """
+    Write one frame, the Body fields of the payload go into the body.
+    Metrics are sent next to the payload (see take_metrics()). Nothing is
+    written if encoding the frame fails.
+    """
+    message, metrics = take_metrics(message)
+    start = clocks()
+    payload = message.get("payload")
+    bodies: List[bytes] = []
+    fields: List[Tuple[str, int]] = []
+    if isinstance(payload, dict) and any(isinstance(v, Body) for v in payload.values()):
+        payload = dict(payload)
+        for name, value in list(payload.items()):
+            if isinstance(value, Body):
+                encoded = [chunk.encode("utf-8") for chunk in value.chunks()]
+                bodies.extend(encoded)
+                fields.append((name, sum(len(chunk) for chunk in encoded)))
+                del payload[name]
+        message = {**message, "payload": payload, "body": fields}
+    header: Union[bytes, memoryview] = dumps(message).encode("utf-8")
+    tail = b""
+    if metrics is not None:
+        metrics.add_since("serialize", start)
+        header = memoryview(header)[:-1]
+        tail = _metrics_field(metrics).encode("utf-8")
+    stream.write(PREFIX.pack(len(header) + len(tail)))
+    stream.write(header)
+    stream.write(tail)
+    for encoded in bodies:
+        stream.write(encoded)
+    stream.flush()
+
+
+def serve_once(handle: Callable[[Dict[str, Any]], Dict[str, Any]]):
+    """
+    One-off script run with `--framed`: handle a single frame from stdin
+    """
+    request = read_frame(sys.stdin.buffer)
+    if request is None:
+        raise EOFError("No request")
+    write_frame(sys.stdout.buffer, {"id": request.get("id"), "payload": handle(request["payload"])})
@@ -1,28 +1,180 @@
+#!/usr/bin/env python3.9
+# Layout of py2json graphs with grandalf's Sugiyama layout.
+#
+# As a script: reads a py2json response (JSON: { 'graph': ... }) from stdin
+# and writes the positions of its nodes (JSON: { 'positions': [{ 'x', 'y' }, ...] }).
 import sys
+import bootstrap
+bootstrap.setup()
+
 import json
-from grandalf.graphs import Vertex, Edge, Graph
-from grandalf.layouts import SugiyamaLayout
 
-graph = json.load(sys.stdin)['graph']
-nodes = graph['nodes']
-edges = graph['edges']
+from typing import Any, Dict, List, Optional, Sequence, Tuple, cast
+
+from cache import LRUCache
+from tracing import get_logger
+from workers import parallel_map
+from metrics import measured, stage
+
+log = get_logger("graphviz")
+
+# Size of a node in the webview
+NODE_WIDTH, NODE_HEIGHT = 172, 36
+# Space between the bounding boxes of disconnected components, stacked top to bottom
+COMPONENT_GAP = 50
+# Laid out graphs and components remembered
+MAX_LAYOUTS = 256
+# Components are laid out in worker processes only when there is enough work to pay for it
+PARALLEL_MIN_NODES = 300
+
+Position = Tuple[float, float]
+# Number of nodes and (source, target) index pairs
+Structure = Tuple[int, Tuple[Tuple[int, int], ...]]
+
+_layouts: LRUCache[Structure, List[Position]] = LRUCache(MAX_LAYOUTS)
+
+
+class _View:
+    # Ranks of the layout go left to right, so grandalf gets the node turned sideways
+    w, h = NODE_HEIGHT, NODE_WIDTH
+
+
+def structure(node_count: int, edges: Sequence[Tuple[int, int]]) -> Structure:
+    return node_count, tuple(edges)
+
+
+def components(node_count: int, edges: Sequence[Tuple[int, int]]) -> List[Tuple[List[int], Structure]]:
+    """
+    Weakly connected components: their nodes (in order) and their structure with
+    the nodes renumbered from 0. Duplicate edges and self loops, which do not
+    change the layout (and which grandalf cannot rank), are left out.
+    """
+    parent = list(range(node_count))
+
+    def find(idx: int) -> int:
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    for source, target in edges:
+        parent[find(source)] = find(target)
+    groups: Dict[int, List[int]] = {}
+    for idx in range(node_count):
+        groups.setdefault(find(idx), []).append(idx)
+    local = {idx: pos for nodes in groups.values() for pos, idx in enumerate(nodes)}
+    group_edges: Dict[int, List[Tuple[int, int]]] = {root: [] for root in groups}
+    seen = set()
+    for source, target in edges:
+        if source != target and (source, target) not in seen:
+            seen.add((source, target))
+            group_edges[find(source)].append((local[source], local[target]))
+    return [(nodes, structure(len(nodes), group_edges[root])) for root, nodes in groups.items()]
+
+
+def layout_component(component: Structure) -> List[Position]:
+    """
+    Top left position of each node of a connected graph, laid out left to right
+    with the bounding box starting at (0, 0)
+    """
+    node_count, edges = component
+    if node_count == 1:
+        return [(0.0, 0.0)]
+    from grandalf.graphs import Vertex, Edge, Graph
+    from grandalf.layouts import SugiyamaLayout
+
+    vertices = [Vertex(idx) for idx in range(node_count)]
+    for vertex in vertices:
+        vertex.view = _View()
+    graph = Graph(vertices, [Edge(vertices[s], vertices[t]) for s, t in edges])
+    sugiyama = SugiyamaLayout(graph.C[0])
+    sugiyama.init_all()
+    sugiyama.draw()
+    # grandalf positions are centers, ranks along y
+    centers = [(v.view.xy[1], v.view.xy[0]) for v in vertices]
+    left = min(x for x, _ in centers) - NODE_WIDTH / 2
+    top = min(y for _, y in centers) - NODE_HEIGHT / 2
+    return [(x - NODE_WIDTH / 2 - left, y - NODE_HEIGHT / 2 - top) for x, y in centers]
+
+
+def layout_components(node_count: int, edges: Sequence[Tuple[int, int]]) -> List[Position]:
+    """
+    Top left position of each node. Every connected component is laid out
+    left to right on its own, the components are stacked below each other.
+    Components which are not cached are laid out in parallel if they are big enough.
+    """
+    parts = components(node_count, edges)
+    # Layouts of this graph's components, the cache may evict them before they are used
+    laid_out: Dict[Structure, Optional[List[Position]]] = {}
+    for _, component in parts:
+        if component not in laid_out:
+            laid_out[component] = _layouts.get(component)
+    todo = [component for component, local in laid_out.items() if local is None]
+    todo_nodes = sum(component[0] for component in todo)
+    parallel = len(todo) > 1 and todo_nodes >= PARALLEL_MIN_NODES
+    if parallel:
+        log.debug("layout of %d components (%d nodes) in worker processes", len(todo), todo_nodes)
+        # Biggest first, so the longest layouts start right away
+        todo.sort(key=lambda component: -component[0])
+    for component, local in zip(todo, parallel_map(layout_component, todo, parallel)):
+        laid_out[component] = local
+        _layouts.put(component, local, component[0])
+
+    positions: List[Position] = [(0.0, 0.0)] * node_count
+    top = 0.0
+    for nodes, component in parts:
+        local = cast(List[Position], laid_out[component])
+        for idx, (x, y) in zip(nodes, local):
+            positions[idx] = (x, y + top)
+        top += max(y for _, y in local) + NODE_HEIGHT + COMPONENT_GAP
+    return positions
+
+
+def layout(node_count: int, edges: Sequence[Tuple[int, int]]) -> List[Position]:
+    """
+    layout_components(), cached by the structure of the graph
+    """
+    key = structure(node_count, edges)
+    positions = _layouts.get(key)
+    if positions is None:
+        log.debug("layout of %d nodes, %d edges", node_count, len(edges))
+        with stage("layout"):
+            positions = layout_components(node_count, edges)
+        _layouts.put(key, positions, node_count)
+    return positions
+
+
+def layout_graph(graph: Dict[str, Any]) -> List[Dict[str, float]]:
+    """
+    Positions of the nodes of a py2json graph (JSON: [{ 'x', 'y' }, ...])
+    """
+    edges = [(edge['source'], edge['target']) for edge in graph['edges']]
+    return [{'x': x, 'y': y} for x, y in layout(len(graph['nodes']), edges)]
 
 
-def label_to_name(label: str):
-    return '"' + label.replace('"', '\\"') + '"'
+def with_layout(graph: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Copy of a py2json graph with the position of every node. The graph is returned
+    as it is if grandalf is not installed, the webview lays it out itself then.
+    """
+    try:
+        positions = layout_graph(graph)
+    except ImportError as e:
+        log.warning("no layout: %s", e)
+        return graph
+    return {
+        **graph,
+        'nodes': [{**node, 'position': position} for node, position in zip(graph['nodes'], positions)],
+    }
 
-vertices = [Vertex(label_to_name(node['data']['label'])) for node in nodes]
-class defaultview(object):
-    w,h = 172,36
-for v in vertices: v.view = defaultview()
-conn = [Edge(vertices[edge['source']], vertices[edge['target']])
-        for edge in edges]
-graph = Graph(vertices, conn)
-layout = SugiyamaLayout(graph.C[0])
-layout.init_all()
-layout.draw()
 
+@measured
+def handle(data):
+    """
+    Serve one request (JSON: { 'graph': py2json graph, 'metrics'? }) and return the response
+    """
+    return {'positions': layout_graph(data['graph'])}
 
-for v in graph.C[0].sV: print("%s: (%d,%d)"%(v.data,v.view.xy[0],v.view.xy[1]))
 
-# print(f"digraph {{ rankdir=LR \n {connections} }}")
+if __name__ == "__main__":
+    json.dump(handle(json.load(sys.stdin)), sys.stdout)
@@ -0,0 +1,304 @@
+import re
+import libcst as cst
+
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+
+from parse import find_flow
+
+T = TypeVar("T")
+
+# Top level assignment, the flow dict follows right after it
+FLOW_ASSIGNMENT = re.compile(r"^(?P<name>[A-Za-z_]\w*)[ \t]*(?::[^=\n]*)?=[ \t]*", re.M)
+# Stands in for the flow while the code around it is parsed
+PLACEHOLDER = "__dd_idde_flow__"
+
+
+@dataclass
+class NodeSpan:
+    """
+    Position of a node dict, relative to the start of the flow dict
+    """
+    start: int
+    end: int
+    flow_idx: int
+    node_idx: int
+
+
+@dataclass
+class Snapshot:
+    """
+    A parsed version of a source, with the position of the flow in it
+    """
+    source: str
+    module: cst.Module
+    flow: Optional[cst.Dict]
+    # Index of the flow assignment in module.body and in its statement line
+    stmt: Optional[Tuple[int, int]] = None
+    # Offsets of the flow dict in the source, -1 if they are not known yet
+    start: int = -1
+    end: int = -1
+    # Computed only when an edit falls inside the flow
+    nodes: Optional[List[NodeSpan]] = None
+
+
+def changed_span(old: str, new: str) -> Tuple[int, int, int]:
+    """
+    Find the region which differs between two strings.
+    Returns its start, and its end in the old and the new string.
+    """
+    limit = min(len(old), len(new))
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old.startswith(new[lo:mid], lo):
+            lo = mid
+        else:
+            hi = mid - 1
+    prefix = lo
+    lo, hi = 0, limit - prefix
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old.endswith(new[len(new) - mid:len(new) - lo], 0, len(old) - lo):
+            lo = mid
+        else:
+            hi = mid - 1
+    return prefix, len(old) - lo, len(new) - lo
+
+
+def replace_item(items: Sequence[T], idx: int, item: T) -> List[T]:
+    return [*items[:idx], item, *items[idx + 1:]]
+
+
+def find_assignment(module: cst.Module, matches: Callable[[cst.Assign], bool]) -> Optional[Tuple[int, int]]:
+    for i, line in enumerate(module.body):
+        if isinstance(line, cst.SimpleStatementLine):
+            for j, stmt in enumerate(line.body):
+                if isinstance(stmt, cst.Assign) and matches(stmt):
+                    return i, j
+    return None
+
+
+def get_assignment(module: cst.Module, stmt: Tuple[int, int]) -> cst.Assign:
+    i, j = stmt
+    line = cst.ensure_type(module.body[i], cst.SimpleStatementLine)
+    return cst.ensure_type(line.body[j], cst.Assign)
+
+
+def replace_value(module: cst.Module, stmt: Tuple[int, int], value: cst.BaseExpression) -> cst.Module:
+    i, j = stmt
+    line = cst.ensure_type(module.body[i], cst.SimpleStatementLine)
+    assign = get_assignment(module, stmt)
+    line = line.with_changes(body=replace_item(line.body, j, assign.with_changes(value=value)))
+    return module.with_changes(body=replace_item(module.body, i, line))
+
+
+def is_placeholder(node: cst.BaseExpression) -> bool:
+    return isinstance(node, cst.Name) and node.value == PLACEHOLDER
+
+
+def value_offset(module: cst.Module, el: cst.DictElement) -> int:
+    """
+    Length of the code before the value of a dict element
+    """
+    code = module.code_for_node
+    return (
+        len(code(el.key))
+        + len(code(el.whitespace_before_colon))
+        + 1
+        + len(code(el.whitespace_after_colon))
+    )
+
+
+def element_length(module: cst.Module, collection: cst.Dict, idx: int) -> int:
+    el = collection.elements[idx]
+    length = len(module.code_for_node(el))
+    # Dict adds the missing commas between the elements when generating code
+    if el.comma is cst.MaybeSentinel.DEFAULT and idx < len(collection.elements) - 1:
+        length += 2
+    return length
+
+
+def opening_length(module: cst.Module, collection: cst.Dict) -> int:
+    code = module.code_for_node
+    return sum(len(code(par)) for par in collection.lpar) + len(code(collection.lbrace))
+
+
+def node_spans(module: cst.Module, flow: cst.Dict) -> List[NodeSpan]:
+    spans = []
+    offset = opening_length(module, flow)
+    for flow_idx, flow_el in enumerate(flow.elements):
+        if isinstance(flow_el, cst.DictElement) and isinstance(flow_el.value, cst.Dict):
+            flow_dict = flow_el.value
+            node_offset = offset + value_offset(module, flow_el) + opening_length(module, flow_dict)
+            for node_idx, node_el in enumerate(flow_dict.elements):
+                if isinstance(node_el, cst.DictElement):
+                    start = node_offset + value_offset(module, node_el)
+                    end = start + len(module.code_for_node(node_el.value))
+                    spans.append(NodeSpan(start, end, flow_idx, node_idx))
+                node_offset += element_length(module, flow_dict, node_idx)
+        offset += element_length(module, flow, flow_idx)
+    return spans
+
+
+class IncrementalParser:
+    """
+    Parses new versions of a source by reusing an earlier version's tree.
+
+    The flow dict is located with a regex scan of the source. If an edit falls
+    outside of it, only the code around the flow is parsed and the old flow subtree
+    is put back. If it falls strictly inside a single node's braces, only that
+    node's dict is parsed and spliced into the flow. Anything else is a full parse.
+    """
+
+    def __init__(self, max_snapshots: int = 4):
+        self.max_snapshots = max_snapshots
+        self.snapshots: List[Snapshot] = []
+        self.counts: Dict[str, int] = {"full": 0, "outside": 0, "node": 0, "flow": 0}
+
+    def parse(self, source: str) -> Tuple[cst.Module, Optional[cst.Dict]]:
+        snapshot = None
+        closest = self._closest(source)
+        if closest is not None:
+            try:
+                snapshot = self._reparse(*closest, source)
+            except cst.ParserSyntaxError:
+                snapshot = None
+        if snapshot is None:
+            self.counts["full"] += 1
+            module = cst.parse_module(source)
+            snapshot = Snapshot(source, module, find_flow(module))
+        self._remember(snapshot)
+        return snapshot.module, snapshot.flow
+
+    def remember(self, source: str, module: cst.Module, flow: Optional[cst.Dict]):
+        self._remember(Snapshot(source, module, flow))
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counts)
+
+    def _remember(self, snapshot: Snapshot):
+        self.snapshots = [s for s in self.snapshots if s.source != snapshot.source]
+        self.snapshots.insert(0, snapshot)
+        del self.snapshots[self.max_snapshots:]
+
+    def _closest(self, source: str) -> Optional[Tuple[Snapshot, Tuple[int, int, int]]]:
+        """
+        The snapshot which has the smallest changed region compared to the source
+        """
+        best = None
+        for snapshot in self.snapshots:
+            span = changed_span(snapshot.source, source)
+            if best is None or span[2] - span[0] < best[1][2] - best[1][0]:
+                best = snapshot, span
+        return best
+
+    def _locate(self, snapshot: Snapshot) -> bool:
+        """
+        Find the flow assignment and the offsets of the flow dict in the source
+        """
+        if snapshot.start >= 0:
+            return True
+        flow = snapshot.flow
+        if flow is None or PLACEHOLDER in snapshot.source:
+            return False
+        stmt = find_assignment(snapshot.module, lambda assign: assign.value is flow)
+        if stmt is None:
+            return False
+        assign = get_assignment(snapshot.module, stmt)
+        names = {
+            target.target.value for target in assign.targets if isinstance(target.target, cst.Name)
+        }
+        flow_code = snapshot.module.code_for_node(flow)
+        for match in FLOW_ASSIGNMENT.finditer(snapshot.source):
+            if match["name"] in names and snapshot.source.startswith(flow_code, match.end()):
+                snapshot.stmt = stmt
+                snapshot.start = match.end()
+                snapshot.end = match.end() + len(flow_code)
+                return True
+        return False
+
+    def _reparse(self, base: Snapshot, span: Tuple[int, int, int], source: str) -> Optional[Snapshot]:
+        if not self._locate(base):
+            return None
+        start, old_end, new_end = span
+        delta = new_end - old_end
+        if old_end <= base.start or start >= base.end:
+            flow_start = base.start + delta if old_end <= base.start else base.start
+            return self._reparse_outside(base, source, flow_start)
+        # Edits of the braces themselves, or right next to them, can change what
+        # the dict is followed by, a parsed expression would drop that
+        if start <= base.start or old_end >= base.end:
+            return None
+
+        if base.nodes is None:
+            base.nodes = node_spans(base.module, base.flow)
+        rel_start, rel_end = start - base.start, old_end - base.start
+        node = next((s for s in base.nodes if s.start < rel_start and rel_end < s.end), None)
+        if node is not None:
+            return self._reparse_node(base, source, node, delta)
+        return self._reparse_flow(base, source, delta)
+
+    def _reparse_outside(self, base: Snapshot, source: str, flow_start: int) -> Optional[Snapshot]:
+        flow_end = flow_start + (base.end - base.start)
+        if PLACEHOLDER in source:
+            return None
+        module = cst.parse_module(source[:flow_start] + PLACEHOLDER + source[flow_end:])
+        stmt = find_assignment(module, lambda assign: is_placeholder(assign.value))
+        if stmt is None:
+            return None
+        module = replace_value(module, stmt, base.flow)
+        snapshot = self._checked(source, module, base.flow)
+        if snapshot is not None:
+            self.counts["outside"] += 1
+            snapshot.stmt, snapshot.start, snapshot.end = stmt, flow_start, flow_end
+            snapshot.nodes = base.nodes
+        return snapshot
+
+    def _reparse_node(self, base: Snapshot, source: str, span: NodeSpan, delta: int) -> Optional[Snapshot]:
+        flow = base.flow
+        value = cst.parse_expression(source[base.start + span.start:base.start + span.end + delta])
+        if not isinstance(value, cst.Dict):
+            return None
+        flow_el = cst.ensure_type(flow.elements[span.flow_idx], cst.DictElement)
+        flow_dict = cst.ensure_type(flow_el.value, cst.Dict)
+        node_el = cst.ensure_type(flow_dict.elements[span.node_idx], cst.DictElement)
+        flow_dict = flow_dict.with_changes(
+            elements=replace_item(flow_dict.elements, span.node_idx, node_el.with_changes(value=value))
+        )
+        new_flow = flow.with_changes(
+            elements=replace_item(flow.elements, span.flow_idx, flow_el.with_changes(value=flow_dict))
+        )
+        snapshot = self._checked(source, replace_value(base.module, base.stmt, new_flow), new_flow)
+        if snapshot is not None:
+            self.counts["node"] += 1
+            snapshot.stmt, snapshot.start, snapshot.end = base.stmt, base.start, base.end + delta
+            snapshot.nodes = [
+                NodeSpan(
+                    s.start + delta if s.start > span.start else s.start,
+                    s.end + delta if s.start >= span.start else s.end,
+                    s.flow_idx,
+                    s.node_idx,
+                )
+                for s in base.nodes
+            ]
+        return snapshot
+
+    def _reparse_flow(self, base: Snapshot, source: str, delta: int) -> Optional[Snapshot]:
+        new_flow = cst.parse_expression(source[base.start:base.end + delta])
+        if not isinstance(new_flow, cst.Dict):
+            return None
+        snapshot = self._checked(source, replace_value(base.module, base.stmt, new_flow), new_flow)
+        if snapshot is not None:
+            self.counts["flow"] += 1
+            snapshot.stmt, snapshot.start, snapshot.end = base.stmt, base.start, base.end + delta
+        return snapshot
+
+    def _checked(self, source: str, module: cst.Module, flow: cst.Dict) -> Optional[Snapshot]:
+        """
+        The spliced module has to give back the source, and the spliced flow has to be
+        the one find_flow() would pick in a fully parsed module
+        """
+        if module.code != source or find_flow(module) is not flow:
+            return None
+        return Snapshot(source, module, flow)
@@ -0,0 +1,121 @@
+import ast
+
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, Tuple, TypeVar
+
+# The ast functions are used without libcst, it is imported by the cst ones
+if TYPE_CHECKING:
+    import libcst as cst
+
+T = TypeVar("T")
+
+# Keys of a dict literal (the name if the key is a plain name) paired with the values,
+# None if the node is not a dict literal
+Items = Callable[[T], Optional[Iterable[Tuple[Optional[str], T]]]]
+
+# Keys of the nodes of a plot
+NODE_KEYS = {"TRANSITIONS", "RESPONSE", "PROCESSING", "MISC", "GLOBAL_TRANSITIONS"}
+
+
+def ast_items(node: ast.AST) -> Optional[Iterable[Tuple[Optional[str], ast.AST]]]:
+    if not isinstance(node, ast.Dict):
+        return None
+    return (
+        (key.id if isinstance(key, ast.Name) else None, value)
+        for key, value in zip(node.keys, node.values)
+    )
+
+
+def cst_items(node: "cst.CSTNode") -> Optional[Iterable[Tuple[Optional[str], "cst.CSTNode"]]]:
+    import libcst as cst
+
+    if not isinstance(node, cst.Dict):
+        return None
+    return (
+        (
+            el.key.value if isinstance(el, cst.DictElement) and isinstance(el.key, cst.Name) else None,
+            el.value,
+        )
+        for el in node.elements
+    )
+
+
+def is_plot(root: T, items: Items[T]) -> bool:
+    """
+    Whether a dict literal is a plot: a dict of flows, which are dicts of nodes (except GLOBAL),
+    which are dicts. The plot has a GLOBAL flow or a node with one of the NODE_KEYS, nodes
+    without transitions (terminal or fallback nodes) are fine. Stops at the first element
+    which does not fit.
+    """
+    flows = items(root)
+    if flows is None:
+        return False
+    keyed = False
+    for flow_name, flow in flows:
+        nodes = items(flow)
+        if nodes is None:
+            return False
+        if flow_name == "GLOBAL":
+            keyed = True
+            continue
+        for _, node in nodes:
+            props = items(node)
+            if props is None:
+                return False
+            if not keyed:
+                keyed = any(key in NODE_KEYS for key, _ in props)
+    return keyed
+
+
+def plot_size(root: T, items: Items[T]) -> Tuple[int, int]:
+    """
+    The number of nodes and transitions of a plot (GLOBAL flow excluded)
+    """
+    nodes, edges = 0, 0
+    for flow_name, flow in items(root) or ():
+        if flow_name == "GLOBAL":
+            continue
+        for _, node in items(flow) or ():
+            nodes += 1
+            for key, value in items(node) or ():
+                if key == "TRANSITIONS":
+                    edges += sum(1 for _ in items(value) or ())
+    return nodes, edges
+
+
+def ast_assignments(tree: ast.Module) -> Iterator[ast.Assign]:
+    """
+    Top level assignments which are the first statement of their line
+    """
+    prev_end = 0
+    for stmt in tree.body:
+        if isinstance(stmt, ast.Assign) and stmt.lineno != prev_end:
+            yield stmt
+        prev_end = stmt.end_lineno or stmt.lineno
+
+
+def cst_assignments(module: "cst.Module") -> Iterator["cst.Assign"]:
+    """
+    Top level assignments which are the first statement of their line
+    """
+    import libcst as cst
+
+    for line in module.body:
+        if isinstance(line, cst.SimpleStatementLine) and isinstance(line.body[0], cst.Assign):
+            yield line.body[0]
+
+
+def locate_ast_flow(tree: ast.Module) -> Optional[ast.Assign]:
+    """
+    The assignment of the plot in an ast
+    """
+    return next((assign for assign in ast_assignments(tree) if is_plot(assign.value, ast_items)), None)
+
+
+def locate_cst_flow(module: "cst.Module") -> Optional["cst.Dict"]:
+    """
+    The plot dict in a libcst module
+    """
+    import libcst as cst
+
+    assign = next((assign for assign in cst_assignments(module) if is_plot(assign.value, cst_items)), None)
+    return None if assign is None else cst.ensure_type(assign.value, cst.Dict)
@@ -0,0 +1,118 @@
+import time
+import tracemalloc
+
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Dict, Optional, Tuple
+
+Handler = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+
+class Metrics:
+    """
+    Wall and CPU time per stage and counters of a single request.
+
+    Stages can be nested, the time of a stage includes the stages it contains.
+    The server sends the metrics next to the payload of the response, encoded after
+    the rest of it (see framing.py), so the time spent serializing the response is
+    included too.
+    """
+
+    def __init__(self, memory: bool = False):
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.counts: Dict[str, int] = {}
+        self.memory = memory
+        self.peak: Optional[int] = None
+
+    def add(self, name: str, wall: float, cpu: float):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = {"wall_ms": wall * 1e3, "cpu_ms": cpu * 1e3, "calls": 1}
+        else:
+            stage["wall_ms"] += wall * 1e3
+            stage["cpu_ms"] += cpu * 1e3
+            stage["calls"] += 1
+
+    def add_since(self, name: str, start: Tuple[float, float]):
+        """
+        Add a stage which started at `start` (see clocks()) and ends now
+        """
+        wall, cpu = start
+        self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def to_json(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"stages": self.stages, "counts": self.counts}
+        if self.peak is not None:
+            result["peak_kb"] = self.peak / 1024
+        return result
+
+
+def clocks() -> Tuple[float, float]:
+    """
+    Wall and CPU clocks, the start of a stage
+    """
+    return time.perf_counter(), time.process_time()
+
+
+_current: ContextVar[Optional[Metrics]] = ContextVar("metrics", default=None)
+
+
+class stage:
+    """
+    Time a stage of the current request, does nothing if no metrics are collected:
+    `with stage("parse"): ...`
+    """
+    __slots__ = ("name", "metrics", "wall", "cpu")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.metrics = _current.get()
+        if self.metrics is not None:
+            self.wall = time.perf_counter()
+            self.cpu = time.process_time()
+
+    def __exit__(self, *exc):
+        if self.metrics is not None:
+            self.metrics.add(self.name, time.perf_counter() - self.wall, time.process_time() - self.cpu)
+
+
+def count(name: str, n: int = 1):
+    """
+    Add to a counter of the current request
+    """
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.counts[name] = metrics.counts.get(name, 0) + n
+
+
+def measured(handle: Handler) -> Handler:
+    """
+    Decorator of the `handle` entry points: with 'metrics' in the request
+    (true, or { 'memory': true } to also trace the peak of allocated memory,
+    which is slow) the response has a 'metrics' field.
+    """
+    @wraps(handle)
+    def wrapper(data: Dict[str, Any]) -> Dict[str, Any]:
+        options = data.get("metrics")
+        if not options:
+            return handle(data)
+        metrics = Metrics(memory=isinstance(options, dict) and bool(options.get("memory")))
+        token = _current.set(metrics)
+        tracing = metrics.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif metrics.memory:
+            tracemalloc.reset_peak()
+        try:
+            with stage("total"):
+                response = handle(data)
+        finally:
+            if metrics.memory:
+                metrics.peak = tracemalloc.get_traced_memory()[1]
+            if tracing:
+                tracemalloc.stop()
+            _current.reset(token)
+        return {**response, "metrics": metrics}
+    return wrapper
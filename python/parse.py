@@ -1,14 +1,29 @@
-import sys
+import re
+import weakref
 import dataclasses
+import functools
 import libcst as cst
 import libcst.matchers as m
 
-from typing import Literal, Optional, Tuple, Union, List, Dict, DefaultDict, Set, cast
+from typing import Literal, Optional, Tuple, Union, List, Dict, DefaultDict, Hashable, Set, cast
 from dataclasses import dataclass, field
 from collections import defaultdict
 
+from locate import locate_cst_flow
+from tracing import TRACE, get_logger, lazy
+
+log = get_logger("parse")
+
 BaseUpdate = Union["ValueUpdate", "ListUpdate", "DictUpdate"]
 
+SIMPLE_STRING = re.compile(r"(?P<prefix>[rRbBuU]{0,2})(?P<quote>'''|\"\"\"|'|\")(?P<content>.*)(?P=quote)", re.S)
+EMPTY_MODULE = cst.Module(body=[])
+# Nodes whose source is their value
+LEAF_NODES = (cst.Name, cst.SimpleString, cst.Integer, cst.Float, cst.Imaginary)
+
+# Generated source of the other nodes compared with values, nodes are immutable
+_node_sources: "weakref.WeakKeyDictionary[cst.CSTNode, str]" = weakref.WeakKeyDictionary()
+
 
 @dataclass
 class KeyUpdate:
@@ -29,10 +44,44 @@ class KeyUpdate:
         return False
 
 
+@functools.lru_cache(maxsize=4096)
+def normalize_key(key: str) -> Hashable:
+    """
+    Normalize the source of a key, so it can be compared without parsing it again.
+    Names and the contents of simple strings compare equal, like `TRANSITIONS`
+    and `"TRANSITIONS"`, tuples are normalized element by element.
+    """
+    if key.isidentifier():
+        return key
+    match = SIMPLE_STRING.fullmatch(key)
+    if match and match["quote"][0] not in match["content"] and "\\" not in match["content"]:
+        return match["content"]
+    try:
+        return normalize_node(cst.parse_expression(key))
+    except cst.ParserSyntaxError:
+        return ("source", key)
+
+
+def normalize_node(node: cst.BaseExpression) -> Hashable:
+    if isinstance(node, cst.Name):
+        return node.value
+    elif isinstance(node, cst.SimpleString):
+        return node.raw_value
+    elif isinstance(node, cst.Tuple):
+        return ("tuple", tuple(normalize_node(el.value) for el in node.elements))
+    return ("source", EMPTY_MODULE.code_for_node(node))
+
+
 @dataclass
 class DictUpdate:
     elements: Dict[KeyUpdate, BaseUpdate] = field(default_factory=dict)
     allow_extra: bool = True
+    # Whether the update is added to a dict which does not have it when it is empty
+    add_empty: bool = True
+    # Normalized old and new keys -> keys of elements, built on the first lookup
+    _index: Optional[DefaultDict[Hashable, List[Tuple[Union[str, KeyUpdate], bool]]]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     @classmethod
     def from_dict(cls, dicitonary: Union[DefaultDict, Dict]):
@@ -56,28 +105,32 @@ class DictUpdate:
         return cast(DictUpdate, convert(dicitonary))
 
     def get(self, key: Union[str, cst.BaseExpression]):
-        target_expr = cst.parse_expression(key) if isinstance(key, str) else key
-        key = getattr(target_expr, "raw_value", key)
-        sys.stderr.write(f"Looking for key {key} in {self.elements}\n\n")
-        for k, v in self.elements.items():
-            if k == key: return k, v
-            expr = cst.parse_expression(str(k)) if k != "" else ""
-            if getattr(expr, "value", None) == key:
-                return k, v
-            if getattr(expr, "raw_value", None) == key:
-                return k, v
-            elif isinstance(expr, cst.BaseExpression) and expr.deep_equals(target_expr):
-                return k, v
-            elif isinstance(k, KeyUpdate):
-                expr = cst.parse_expression(str(k.new_key)) if k.new_key != "" else ""
-                if getattr(expr, "value", None) == key:
-                    return k.new_key, v
-                if getattr(expr, "raw_value", None) == key:
-                    return k.new_key, v
-                elif isinstance(expr, cst.BaseExpression) and expr.deep_equals(target_expr):
-                    return k.new_key, v
-                
-        return None, None
+        log.log(TRACE, "Looking for key %s in %s", key, self.elements)
+        found = self.find(key)
+        if found is None:
+            return None, None
+        dict_key, is_new = found
+        if is_new:
+            return dict_key.new_key, self.elements[dict_key]
+        return dict_key, self.elements[dict_key]
+
+    def find(self, key: Union[str, cst.BaseExpression]) -> Optional[Tuple[Union[str, KeyUpdate], bool]]:
+        """
+        Look up the key among both the old and the new keys of the elements.
+        Returns the key in `elements` and whether the match was on its new key.
+        """
+        if self._index is None:
+            self._index = defaultdict(list)
+            for k in self.elements.keys():
+                self._index[normalize_key(str(k))].append((k, False))
+                if isinstance(k, KeyUpdate):
+                    self._index[normalize_key(k.new_key)].append((k, True))
+        norm = normalize_key(key) if isinstance(key, str) else normalize_node(key)
+        # Elements are only ever removed after the index is built
+        for dict_key, is_new in self._index.get(norm, ()):
+            if dict_key in self.elements:
+                return dict_key, is_new
+        return None
 
     def pop(self, key: Union[str, cst.BaseExpression], _) -> Union[Tuple[None, None], Tuple[str, Optional[BaseUpdate]]]:
         if isinstance(key, (cst.Name, cst.SimpleString)):
@@ -90,22 +143,18 @@ class DictUpdate:
             str_key = key
         else:
             raise TypeError(f"Unsupported type {type(key)}")
-        found_key, _ = self.get(str_key)
-        if found_key is None:
-            sys.stderr.write(f"{key}: found_key is none\n")
+        found = self.find(str_key)
+        if found is None:
+            log.debug("%s: found_key is none", key)
             return None, None
+        found_key, _ = found
         if isinstance(found_key, KeyUpdate):
             new_key = found_key.new_key
-            sys.stderr.write(f"found_key KeyUpdate {found_key}, new {new_key}\n")
-            return new_key, self.elements.pop(found_key, None)
+            log.debug("found_key KeyUpdate %s, new %s", found_key, new_key)
         else:
-            sys.stderr.write(f"found_key str {found_key}\n")
+            log.debug("found_key str %s", found_key)
             new_key = found_key
-            if found_key not in self.elements:
-                for k in self.elements.keys():
-                    if isinstance(k, KeyUpdate) and k.new_key == found_key:
-                        return new_key, self.elements.pop(k, None)
-            return new_key, self.elements.pop(found_key, None)
+        return new_key, self.elements.pop(found_key, None)
 
     def __iter__(self):
         for k in list(self.elements.keys()):
@@ -132,69 +181,53 @@ class ListUpdate:
             yield ret
 
 
+@functools.lru_cache(maxsize=4096)
+def parse_value(value: str) -> cst.BaseExpression:
+    """
+    Parse the source of a value, identical sources share one (immutable) expression
+    """
+    return cst.parse_expression(value)
+
+
+def node_source(node: cst.BaseExpression) -> str:
+    """
+    Source of an expression: the value of a leaf, otherwise generated once per node
+    """
+    if isinstance(node, LEAF_NODES) and not node.lpar:
+        return node.value
+    source = _node_sources.get(node)
+    if source is None:
+        source = _node_sources[node] = EMPTY_MODULE.code_for_node(node).strip()
+    return source
+
+
 @dataclass
 class ValueUpdate:
     value: str = ""
     remove: bool = False
-    parsed: cst.BaseExpression = field(init=False, repr=False)
 
-    def __post_init__(self):
-        self.parsed = cst.parse_expression(self.value)
+    @property
+    def parsed(self) -> cst.BaseExpression:
+        # Only parsed when the value is emitted or compared structurally
+        return parse_value(self.value)
 
     def __eq__(self, b: Union[BaseUpdate, cst.BaseExpression]) -> bool:
         if isinstance(b, cst.BaseExpression):
+            if node_source(b) == self.value.strip():
+                return True
             return b.deep_equals(self.parsed)
         elif isinstance(b, ValueUpdate):
+            if b.value.strip() == self.value.strip():
+                return True
             return self.parsed.deep_equals(b.parsed)
         return NotImplemented
 
 
 def find_flow(py_tree: cst.Module) -> Optional[cst.Dict]:
-    for line in py_tree.body:
-        # It's an assign
-        if isinstance(line.body, cst.BaseSuite) or not isinstance(
-            line.body[0], cst.Assign
-        ):
-            continue
-        assign = line.body[0]
-        # The value is a dict
-        if not isinstance(assign.value, cst.Dict):
-            continue
-        root_dict = assign.value
-        # All values of this dict are all dicts (the flows)
-        root_all_dicts = all(
-            isinstance(el.value, cst.Dict) for el in root_dict.elements
-        )
-        if not root_all_dicts:
-            continue
-        # All flows are made up of dicts (nodes)
-        flow_dicts = [
-            cst.ensure_type(el.value, cst.Dict)
-            for el in root_dict.elements
-            if not m.matches(el, m.DictElement(key=m.Name("GLOBAL")))
-        ]
-        flows_all_have_dicts = all(
-            isinstance(el.value, cst.Dict)
-            for flow in flow_dicts
-            for el in flow.elements
-        )
-        if not flows_all_have_dicts:
-            continue
-        # All nodes have TRANSITIONS key
-        nodes = [
-            cst.ensure_type(el.value, cst.Dict)
-            for flow in flow_dicts
-            for el in flow.elements
-        ]
-        all_nodes = all(
-            any(
-                m.matches(el, m.DictElement(key=m.Name("TRANSITIONS")))
-                for el in node.elements
-            )
-            for node in nodes
-        )
-        if all_nodes:
-            return root_dict
+    """
+    The plot dict of a module (see locate.py)
+    """
+    return locate_cst_flow(py_tree)
 
 
 CollectionNode = Union[cst.Dict, cst.List]
@@ -203,8 +236,10 @@ CollectionNode = Union[cst.Dict, cst.List]
 class NodeVisitor(m.MatcherDecoratableTransformer):
     module: cst.Module
     update: DictUpdate
-    path: List[Union[str, int]] = []
-    indent_stack: List[str] = []
+    path: List[Union[str, int]]
+    # Update targets resolved along the path, the last one belongs to the current node
+    targets: List[Optional[BaseUpdate]]
+    indent_stack: List[str]
 
     @property
     def depth(self) -> int:
@@ -214,25 +249,32 @@ class NodeVisitor(m.MatcherDecoratableTransformer):
         super().__init__()
         self.update = update
         self.module = module
-
-    def get_target(self):
-        current = self.update
-        current_path = self.path.copy()
-        while len(current_path) > 0:
-            part = current_path.pop(0)
-            if isinstance(current, DictUpdate) and isinstance(part, str):
-                _, current = current.get(part)
-            elif isinstance(current, ListUpdate) and isinstance(part, int):
-                current = (
-                    current.elements[part] if part < len(current.elements) else None
-                )
-            elif current is None:
-                break
-            else:
-                raise ValueError(
-                    f"Invalid path \"{'.'.join(str(i) for i in self.path)}\" in"
-                )
-        return current
+        # Per-instance state, the server reuses the process between transforms
+        self.path = []
+        self.targets = [update]
+        self.indent_stack = []
+
+    def path_str(self) -> str:
+        return '.'.join(str(i) for i in self.path)
+
+    def get_target(self) -> Optional[BaseUpdate]:
+        return self.targets[-1]
+
+    def resolve_target(self, part: Union[str, int]) -> Optional[BaseUpdate]:
+        """
+        Target of the child at `part` of the current target
+        """
+        current = self.targets[-1]
+        if isinstance(current, DictUpdate) and isinstance(part, str):
+            _, current = current.get(part)
+            return current
+        elif isinstance(current, ListUpdate) and isinstance(part, int):
+            return current.elements[part] if part < len(current.elements) else None
+        elif current is None:
+            return None
+        raise ValueError(
+            f"Invalid path \"{self.path_str()}.{part}\" in"
+        )
 
     def get_delim_ws(
         self, node: CollectionNode, side: Union[Literal["l"], Literal["r"]]
@@ -369,21 +411,27 @@ class NodeVisitor(m.MatcherDecoratableTransformer):
 
     # Do not enter non collection nodes
     def on_visit(self, node: cst.CSTNode) -> bool:
-        should_visit = super().on_visit(node)
-        if not m.matches(node, m.Dict() | m.List() | m.DictElement() | m.Element()):
-            should_visit = False
-        return should_visit
+        if not isinstance(node, (cst.Dict, cst.List, cst.DictElement, cst.Element)):
+            return False
+        return super().on_visit(node)
 
     # Keeping track of our current path inside the flow
     def visit_DictElement(self, node: cst.DictElement):
         if isinstance(node.key, (cst.Name, cst.SimpleString)):
+            target = self.resolve_target(node.key.value)
             self.path.append(node.key.value)
+            self.targets.append(target)
         else:
             self.path.append("")
+            self.targets.append(None)
+            return False
+        # Nothing to update below this element, it is kept as it is
+        if target is None:
             return False
 
     def leave_DictElement(self, _, updated: cst.DictElement):
         self.path.pop()
+        self.targets.pop()
         return updated
 
     @m.visit(m.Dict() | m.List())
@@ -400,19 +448,17 @@ class NodeVisitor(m.MatcherDecoratableTransformer):
             base_indent = self.offset_indent(self.indent_stack.pop(), -1)
         else:
             base_indent = self.indent_stack[-1] if len(self.indent_stack) > 0 else ""
-        sys.stderr.write(
-            f"{'.'.join(str(i) for i in self.path)}: {len(base_indent)/len(self.module.default_indent)}\n"
+        log.debug(
+            "%s: %s", lazy(self.path_str), len(base_indent) / len(self.module.default_indent)
         )
 
         target = self.get_target()
-        sys.stderr.write(
-            f"transforming node {type(node)} in path {'.'.join(str(i) for i in self.path)}, update: {type(target)}\n"
+        log.debug(
+            "transforming node %s in path %s, update: %s", type(node), lazy(self.path_str), type(target)
         )
         if target is None:
-            sys.stderr.write(
-                f"code for updated node: {self.module.code_for_node(node)}\n"
-            )
-            return node
+            log.log(TRACE, "code for updated node: %s", lazy(self.module.code_for_node, original))
+            return original
 
         if isinstance(target, DictUpdate) and not isinstance(node, cst.Dict):
             raise TypeError(
@@ -473,6 +519,13 @@ class NodeVisitor(m.MatcherDecoratableTransformer):
                 # Not in update, but extra is allowed
                 new_elements.append(el)
 
+        if isinstance(target, DictUpdate):
+            for key in [
+                key for key, update in target.elements.items()
+                if isinstance(update, DictUpdate) and not update.elements and not update.add_empty
+            ]:
+                del target.elements[key]
+
         right_ws = self.get_delim_ws(node, "r")
         if len(new_elements) > 0:
             comma = cst.Comma(whitespace_after=right_ws.deep_clone())
@@ -480,7 +533,7 @@ class NodeVisitor(m.MatcherDecoratableTransformer):
         if len(target.elements) > 0:
             right_ws = cst.SimpleWhitespace("")
 
-        sys.stderr.write(f"Remaining {target.elements}\n")
+        log.log(TRACE, "Remaining %s", target.elements)
         # Remaining elements
         for key, update in target:
             key = (
@@ -530,5 +583,5 @@ class NodeVisitor(m.MatcherDecoratableTransformer):
                 node, base_indent, is_expanded, is_expanded and has_trailing_comma
             )
 
-        sys.stderr.write(f"code for updated node: {self.module.code_for_node(node)}\n")
+        log.log(TRACE, "code for updated node: %s", lazy(self.module.code_for_node, node))
         return node
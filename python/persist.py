@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import mmap
+import time
+import shutil
+import struct
+import hashlib
+import pathlib
+import tempfile
+
+from typing import Any, Dict, Optional
+
+import bootstrap
+from tracing import get_logger
+
+log = get_logger("persist")
+
+# Cache directory, "off" disables the disk cache
+CACHE_DIR_ENV = "DD_IDDE_CACHE_DIR"
+# Entries of other converter versions not used for this long are deleted
+MAX_AGE = 30 * 24 * 3600
+
+# Entry file: magic, format, length of the payload, then the payload
+HEADER = struct.Struct(">4sBI")
+MAGIC = b"DDGC"
+FORMAT_JSON, FORMAT_TEXT = 0, 1
+
+
+def default_dir() -> Optional[str]:
+    directory = os.environ.get(CACHE_DIR_ENV)
+    if directory is not None:
+        return None if directory == "off" else directory
+    # Not the cache directory itself, clear() and pruning delete what is in the directory
+    return str(bootstrap.cache_home() / "graphs")
+
+
+def converter_version() -> str:
+    """
+    Hash of the converter sources and the python version, entries written
+    by other versions of the converters are never read
+    """
+    digest = hashlib.sha1(repr(sys.version_info[:2]).encode("utf-8"))
+    for path in sorted(pathlib.Path(__file__).parent.glob("*.py")):
+        digest.update(path.name.encode("utf-8"))
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+class DiskCache:
+    """
+    Graphs (JSON) and documents (text) built from a source, stored on disk
+    by the hash of the source, so they survive restarts of the server.
+
+    Entries are written to a temporary file which is then renamed, readers never
+    see a partial entry. They are read through mmap, without a separate read buffer.
+    A broken or unreadable entry is a miss, disk errors never fail a conversion.
+    """
+
+    def __init__(self, directory: str, version: Optional[str] = None):
+        self.version = version or converter_version()
+        self.root = pathlib.Path(directory)
+        self.directory = self.root / self.version
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.errors = 0
+        self._pruned = False
+
+    def path(self, key: str, kind: str) -> pathlib.Path:
+        return self.directory / key[:2] / f"{key}-{kind}"
+
+    def get(self, key: str, kind: str) -> Any:
+        """
+        The value stored for a source hash and a converter, None if there is none
+        """
+        path = self.path(key, kind)
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                value = self._decode(data)
+        except FileNotFoundError:
+            value = None
+        except (OSError, ValueError) as e:
+            log.warning("broken cache entry %s: %s", path, e)
+            self.errors += 1
+            self._unlink(path)
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, kind: str, value: Any):
+        if isinstance(value, str):
+            fmt, payload = FORMAT_TEXT, value.encode("utf-8")
+        else:
+            fmt, payload = FORMAT_JSON, json.dumps(value, separators=(",", ":")).encode("utf-8")
+        path = self.path(key, kind)
+        try:
+            self._prune()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(HEADER.pack(MAGIC, fmt, len(payload)))
+                    f.write(payload)
+                os.replace(tmp, path)
+            except BaseException:
+                self._unlink(pathlib.Path(tmp))
+                raise
+        except OSError as e:
+            log.warning("cannot write cache entry %s: %s", path, e)
+            self.errors += 1
+            return
+        self.writes += 1
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "directory": str(self.directory),
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "errors": self.errors,
+        }
+
+    @staticmethod
+    def _decode(data: mmap.mmap) -> Any:
+        if len(data) < HEADER.size:
+            raise ValueError("truncated header")
+        magic, fmt, length = HEADER.unpack_from(data)
+        if magic != MAGIC or len(data) != HEADER.size + length:
+            raise ValueError("not a cache entry")
+        if fmt not in (FORMAT_TEXT, FORMAT_JSON):
+            raise ValueError(f"unknown format {fmt}")
+        # Decoded straight from the mapped file, slicing it would copy the payload
+        with memoryview(data) as view, view[HEADER.size:] as payload:
+            text = str(payload, "utf-8")
+        return text if fmt == FORMAT_TEXT else json.loads(text)
+
+    def _prune(self):
+        """
+        Delete the entries of other converter versions which were not written to for a while
+        """
+        if self._pruned:
+            return
+        self._pruned = True
+        if not self.root.is_dir():
+            return
+        now = time.time()
+        for directory in self.root.iterdir():
+            if directory.name != self.version and directory.is_dir() and now - directory.stat().st_mtime > MAX_AGE:
+                log.debug("deleting old cache %s", directory)
+                shutil.rmtree(directory, ignore_errors=True)
+
+    @staticmethod
+    def _unlink(path: pathlib.Path):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+
+def open_disk_cache(directory: Optional[str] = None) -> Optional[DiskCache]:
+    directory = directory or default_dir()
+    return None if directory is None else DiskCache(directory)
@@ -1,13 +1,20 @@
 #!/usr/bin/env python3.9
-import sys, pathlib
-deps_path = pathlib.Path(__file__).parent.absolute() / "deps.zip"
-sys.path.insert(0, str(deps_path))
+import sys
+import bootstrap
+bootstrap.setup()
 
 import json
 from base64 import b64encode
 import libcst as cst
-from parse import find_flow
-from typing import Dict, List, Any, Tuple, cast
+from cache import parse_cache
+from framing import Body, serve_once, text_field
+from graphviz import layout
+from metrics import count, measured, stage
+from titles import Title, cst_title
+from tracing import get_logger
+from typing import Dict, Iterator, List, Any, Optional, TextIO, Tuple, cast
+
+log = get_logger("py2drawio")
 
 def esc(s: str):
     return s.replace("&", "&amp;") \
@@ -22,6 +29,7 @@ class Node:
     name: str
     misc: Dict[str, str]
     transitions: Dict[Tuple[str, str], str]
+    titles: Dict[Tuple[str, str], Title]
     sfcs: List[str]
 
     def __init__(self, name: str, flow_name: str, node: cst.Dict, module: cst.Module):
@@ -29,6 +37,7 @@ class Node:
         self.flow_name = flow_name
         self.misc = {}
         self.transitions = {}
+        self.titles = {}
         self.sfcs = []
         for node_prop_el in node.elements:
             if not isinstance(node_prop_el, cst.DictElement): continue
@@ -50,6 +59,7 @@ class Node:
                 target_name = module.code_for_node(elem.key)
             desc = module.code_for_node(elem.value)
             self.transitions[(flow, target_name)] = desc
+            self.titles[(flow, target_name)] = cst_title(desc, elem.value, module)
 
     def _parse_misc(self, misc: cst.Dict, module: cst.Module):
         for elem in misc.elements:
@@ -90,7 +100,8 @@ def parse_flow(flow_node: cst.Dict, module: cst.Module):
                 # sys.stderr.write(f"Edge from node {node_name} -> {target}\n")
                 node_data['edges'][target] = {
                     "title": desc,
-                    "id":  node_id
+                    "id":  node_id,
+                    "label": node.titles[target],
                 }
                 node_id += 3 # Each edge will need three cells
             flow[node_name] = node_data
@@ -98,27 +109,66 @@ def parse_flow(flow_node: cst.Dict, module: cst.Module):
     return nodes, valid_node_names
 
 
-def graph2drawio(graph, valid_node_names):
+# Styles and fixed parts of the document, shared by all the cells written
+EDGE_STYLE = "edgeStyle=orthogonalEdgeStyle;rounded=0;orthogonalLoop=1;jettySize=auto;html=1;noEdgeStyle=1;orthogonal=1;"
+NODE_STYLE = "swimlane;fontStyle=0;fontColor=default;childLayout=stackLayout;horizontal=1;startSize=26;fillColor=#dae8fc;horizontalStack=0;resizeParent=1;resizeParentMax=0;resizeLast=0;collapsible=1;marginBottom=0;strokeColor=#6c8ebf;autosize=1;"
+CND_STYLE = "swimlane;fontColor=default;fontStyle=0;childLayout=stackLayout;horizontal=1;startSize=26;fillColor=#fff2cc;horizontalStack=0;resizeParent=1;resizeParentMax=0;resizeLast=0;collapsible=1;marginBottom=0;strokeColor=#d6b656;autosize=1;"
+TEXT_STYLE = "text;strokeColor=none;fontColor=default;fillColor={fill};align=left;verticalAlign=top;spacingLeft=4;spacingRight=4;overflow=hidden;rotatable=0;points=[[0,0.5],[1,0.5]];portConstraint=eastwest;fontStyle=2;whiteSpace=wrap"
+NODE_TEXT_STYLE = TEXT_STYLE.format(fill="none")
+CND_TEXT_STYLE = TEXT_STYLE.format(fill="white")
+DIAGRAM_ID = b64encode("flow".encode()).decode()
+TAIL = """
+                    <mxCell id="3" value="Suggestions" parent="0"/>
+                    </root>
+                </mxGraphModel>
+            </diagram>
+        </mxfile>"""
+
+
+def drawio_layout(graph) -> Optional[Dict[int, Tuple[int, int]]]:
     """
-    Convert graph to .drawio data
+    Positions of the node and condition cells (by cell id) from the layout service,
+    None if grandalf is not installed
     """
-    edge_style = "edgeStyle=orthogonalEdgeStyle;rounded=0;orthogonalLoop=1;jettySize=auto;html=1;noEdgeStyle=1;orthogonal=1;"
-    diagram_id = b64encode("flow".encode()).decode()
-    head = f"""<mxfile host="65bd71144e" scale="1" border="0">
-        <diagram id="{diagram_id}" name="Page-1">
+    index: Dict[int, int] = {}
+    for flow_data in graph.values():
+        for data in flow_data.values():
+            index[data['id']] = len(index)
+    links = []
+    for flow_data in graph.values():
+        for data in flow_data.values():
+            for (target_flow, target_name), edge_data in data['edges'].items():
+                try:
+                    target_id = graph[target_flow][target_name]['id']
+                except KeyError:
+                    continue
+                cnd = index.setdefault(edge_data['id'] + 1, len(index))
+                links.append((index[data['id']], cnd))
+                links.append((cnd, index[target_id]))
+    try:
+        positions = layout(len(index), links)
+    except ImportError as e:
+        log.warning("no layout: %s", e)
+        return None
+    # Keep the corner of the diagram where the stacked layout starts
+    return {
+        cell_id: (150 + round(positions[idx][0]), 70 + round(positions[idx][1]))
+        for cell_id, idx in index.items()
+    }
+
+
+def iter_drawio(graph, valid_node_names, positions: Optional[Dict[int, Tuple[int, int]]] = None) -> Iterator[str]:
+    """
+    Convert graph to .drawio data, yields the document in chunks of a cell or two.
+    Without `positions` the nodes of each flow are stacked in a column.
+    """
+    yield f"""<mxfile host="65bd71144e" scale="1" border="0">
+        <diagram id="{DIAGRAM_ID}" name="Page-1">
             <mxGraphModel dx="1494" dy="610" grid="1" gridSize="10" guides="1" tooltips="1" connect="1" arrows="1" fold="1" page="1" pageScale="1" pageWidth="827" pageHeight="1169" math="0" shadow="0">
                 <root>
                     <mxCell id="0"/>
                     <mxCell id="2" flows_name= "flow" value="flow" parent="0" nodenames="{esc(json.dumps(list(valid_node_names)))}"/>
     """
-    tail = """
-                    <mxCell id="3" value="Suggestions" parent="0"/>
-                    </root>
-                </mxGraphModel>
-            </diagram>
-        </mxfile>"""
-
-    output = head
     y_shift = 0
     for flow_name, flow_data in graph.items():
         flow_name = esc(flow_name)
@@ -127,98 +177,133 @@ def graph2drawio(graph, valid_node_names):
                 sfcs = data['sfcs'][0]
             else:
                 sfcs = ""
-            sys.stderr.write(f"{sfcs}\n")
-            # assert False
+            log.debug("%s", sfcs)
             data_from_form = {
                 "node_title": node_name,
                 "old_titles": [node_name],
                 "sfc": sfcs
             }
             data_from_form = esc(json.dumps(data_from_form))
-            # sys.stderr.write(f"{node_name}: {data['id']}\n")
             node_name = esc(node_name)
-            node_text = f"""
+            x, y = positions[data['id']] if positions else (150, 70 + y_shift)
+            yield f"""
                 <UserObject data_from_form="{data_from_form}" label="{node_name}" id="{data['id']}">
-                    <mxCell id="{data['id'] + 1}" label="{node_name}" style="swimlane;fontStyle=0;fontColor=default;childLayout=stackLayout;horizontal=1;startSize=26;fillColor=#dae8fc;horizontalStack=0;resizeParent=1;resizeParentMax=0;resizeLast=0;collapsible=1;marginBottom=0;strokeColor=#6c8ebf;autosize=1;" vertex="1" parent="2" collapsed="1">
-                          <mxGeometry x="150" y="{70 + y_shift}" width="150" height="26" as="geometry">
+                    <mxCell id="{data['id'] + 1}" label="{node_name}" style="{NODE_STYLE}" vertex="1" parent="2" collapsed="1">
+                          <mxGeometry x="{x}" y="{y}" width="150" height="26" as="geometry">
                               <mxRectangle x="10" y="40" width="150" height="90" as="alternateBounds" />
                           </mxGeometry>
                     </mxCell>
                 </UserObject>
-                <mxCell isnode="1" id="{data['id'] + 2}" old_title="{node_name}" parent="{data['id']}" label="{node_name}" value="" flow="{flow_name}" style="text;strokeColor=none;fontColor=default;fillColor=none;align=left;verticalAlign=top;spacingLeft=4;spacingRight=4;overflow=hidden;rotatable=0;points=[[0,0.5],[1,0.5]];portConstraint=eastwest;fontStyle=2;whiteSpace=wrap" vertex="1" >
+                <mxCell isnode="1" id="{data['id'] + 2}" old_title="{node_name}" parent="{data['id']}" label="{node_name}" value="" flow="{flow_name}" style="{NODE_TEXT_STYLE}" vertex="1" >
                     <mxGeometry y="26" width="150" height="64" as="geometry" />
                 </mxCell>
             """
-            output += node_text
             for (target_flow, target_name), edge_data in data['edges'].items():
-                # sys.stderr.write(f"{edge_data}\n")
                 try:
                     target_id = graph[target_flow][target_name]['id']
                 except KeyError:
                     continue
                 if isinstance(target_id, str):
                     target_id = esc(target_id)
-                parsed = cst.parse_expression(edge_data['title'])
-                cndlist = []
-                if isinstance(parsed, cst.Call) and len(parsed.args) > 0:
-                    mod = cst.parse_module(edge_data['title'])
-                    if isinstance(parsed.args[0].value, cst.List):
-                        cndlist = [mod.code_for_node(el.value) for el in parsed.args[0].value.elements]
-                        if isinstance(parsed.func, cst.Attribute):
-                            title = parsed.func.attr.value.capitalize()
-                        else:
-                            title = edge_data['title']
-                    elif "sf" in mod.code_for_node(parsed.func):
-                        title = mod.code_for_node(parsed.args[0])
-                    else:
-                        title = edge_data['title']
-                else:
-                    title = edge_data['title']
+                title, cndlist = edge_data['label']
+                cnd_x, cnd_y = positions[edge_data['id'] + 1] if positions else (150, 70 + y_shift)
                 title = esc(title)
-                edge_text = f"""
-                    <mxCell isedge="1" id="{edge_data['id']}" flow="{flow_name}" style="{edge_style}" parent="2" source="{data["id"]}" target="{edge_data['id'] + 1}" reallabel="{esc(edge_data['title'])}" realtarget="{int(target_id)}" edge="1">
+                yield f"""
+                    <mxCell isedge="1" id="{edge_data['id']}" flow="{flow_name}" style="{EDGE_STYLE}" parent="2" source="{data["id"]}" target="{edge_data['id'] + 1}" reallabel="{esc(edge_data['title'])}" realtarget="{int(target_id)}" edge="1">
                         <mxGeometry relative="1" as="geometry">
                             <Array as="points">
-                                <mxPoint x="150" y="{70 + y_shift}"/>
-                                <mxPoint x="150" y="{70 + y_shift}"/>
+                                <mxPoint x="{x}" y="{y}"/>
+                                <mxPoint x="{x}" y="{y}"/>
                             </Array>
                         </mxGeometry>
                     </mxCell>
-                    <mxCell id="{edge_data['id'] + 2}" flow="{flow_name}" style="{edge_style}" parent="2" source="{edge_data['id'] + 1}" target="{target_id}" edge="1">
+                    <mxCell id="{edge_data['id'] + 2}" flow="{flow_name}" style="{EDGE_STYLE}" parent="2" source="{edge_data['id'] + 1}" target="{target_id}" edge="1">
                         <mxGeometry relative="1" as="geometry">
                             <Array as="points">
-                                <mxPoint x="150" y="{70 + y_shift}"/>
-                                <mxPoint x="150" y="{70 + y_shift}"/>
+                                <mxPoint x="{cnd_x}" y="{cnd_y}"/>
+                                <mxPoint x="{cnd_x}" y="{cnd_y}"/>
                             </Array>
                         </mxGeometry>
                     </mxCell>
-                    <mxCell id="{edge_data['id'] + 1}" value="{title}" style="swimlane;fontColor=default;fontStyle=0;childLayout=stackLayout;horizontal=1;startSize=26;fillColor=#fff2cc;horizontalStack=0;resizeParent=1;resizeParentMax=0;resizeLast=0;collapsible=1;marginBottom=0;strokeColor=#d6b656;autosize=1;" vertex="1" parent="2" collapsed="1">
-                          <mxGeometry x="150" y="{70 + y_shift}" width="150" height="26" as="geometry">
+                    <mxCell id="{edge_data['id'] + 1}" value="{title}" style="{CND_STYLE}" vertex="1" parent="2" collapsed="1">
+                          <mxGeometry x="{cnd_x}" y="{cnd_y}" width="150" height="26" as="geometry">
                               <mxRectangle x="10" y="40" width="150" height="90" as="alternateBounds" />
                           </mxGeometry>
                     </mxCell>
                 """
                 for cnd in cndlist:
-                    edge_text += f"""
-                        <mxCell parent="{edge_data['id'] + 1}" value="{esc(cnd)}" style="text;strokeColor=none;fontColor=default;fillColor=white;align=left;verticalAlign=top;spacingLeft=4;spacingRight=4;overflow=hidden;rotatable=0;points=[[0,0.5],[1,0.5]];portConstraint=eastwest;fontStyle=2;whiteSpace=wrap" vertex="1" >
+                    yield f"""
+                        <mxCell parent="{edge_data['id'] + 1}" value="{esc(cnd)}" style="{CND_TEXT_STYLE}" vertex="1" >
                             <mxGeometry y="26" width="150" height="30" as="geometry" />
                         </mxCell>
                     """
-                output += edge_text
         y_shift += 300
-    output += tail
-    return output
+    yield TAIL
+
+
+def graph2drawio(graph, valid_node_names, positions=None) -> str:
+    """
+    Convert graph to .drawio data
+    """
+    with stage("xml"):
+        return "".join(iter_drawio(graph, valid_node_names, positions))
 
 
-def pipeline(content):
-    module = cst.parse_module(content)
-    flow_node = find_flow(module)
+def write_drawio(graph, valid_node_names, out: TextIO, positions=None):
+    """
+    Convert graph to .drawio data written straight to `out`, without building the whole document
+    """
+    for chunk in iter_drawio(graph, valid_node_names, positions):
+        out.write(chunk)
+
+
+def parse_pipeline(content):
+    module, flow_node = parse_cache.flow(content)
     assert flow_node is not None
-    nodes, valid_node_names = parse_flow(flow_node, module)
-    xml = graph2drawio(nodes, valid_node_names)
-    return xml
+    nodes, valid_node_names = parse_cache.graph(
+        content, "py2drawio", lambda: flows(flow_node, module)
+    )
+    count("nodes", sum(len(flow_data) for flow_data in nodes.values()))
+    count("edges", sum(len(data['edges']) for flow_data in nodes.values() for data in flow_data.values()))
+    return nodes, valid_node_names
+
+
+def flows(flow_node, module):
+    with stage("flows"):
+        return parse_flow(flow_node, module)
+
+
+def drawio_chunks(content, with_layout=False) -> Iterator[str]:
+    """
+    The document of a source in chunks (see iter_drawio()). The source is parsed
+    and laid out right away, the chunks are generated as they are read.
+    """
+    nodes, valid_node_names = parse_pipeline(content)
+    positions = drawio_layout(nodes) if with_layout else None
+    return iter_drawio(nodes, valid_node_names, positions)
+
+
+def pipeline(content, with_layout=False) -> str:
+    with stage("xml"):
+        return "".join(drawio_chunks(content, with_layout))
+
+
+@measured
+def handle(data):
+    """
+    Serve one request (JSON: { 'pycode': base64, 'layout'?, 'metrics'? }) and return the response.
+    With 'layout' the cells are placed by the layout service (see graphviz.py).
+    The document is streamed into the body of the response frame, in JSON it is
+    joined; the time spent generating it then counts as serialization.
+    """
+    content = text_field(data, 'pycode')
+    return {'xml': Body(drawio_chunks(content, bool(data.get('layout'))))}
 
 
-content = sys.stdin.read()
-data = pipeline(content)
-sys.stdout.write(data)
+if __name__ == "__main__" and "--framed" in sys.argv[1:]:
+    serve_once(handle)
+elif __name__ == "__main__":
+    content = sys.stdin.read()
+    nodes, valid_node_names = parse_pipeline(content)
+    positions = drawio_layout(nodes) if "--layout" in sys.argv[1:] else None
+    write_drawio(nodes, valid_node_names, sys.stdout, positions)
@@ -1,31 +1,78 @@
 #!/usr/bin/env python3.9
-import sys, pathlib
-deps_path = pathlib.Path(__file__).parent.absolute() / "deps.zip"
-sys.path.insert(0, str(deps_path))
+import sys
+import bootstrap
+bootstrap.setup()
 
+import re
 import ast
 import json
-import base64
-import libcst as cst
+from typing import List, Optional
+
+from cache import parse_cache
+from delta import graph_sessions
+from titles import ast_title
+from locate import locate_ast_flow
+from graphviz import with_layout
+from framing import dumps, serve_once, text_field
+from metrics import count, measured, stage
+from tracing import get_logger
 
 # from grandalf.graphs import graph_core, Edge, Vertex, Graph
 # from grandalf.layouts import SugiyamaLayout,DigcoLayout,VertexViewer,Layer,DummyVertex
 # from grandalf.routing import EdgeViewer, route_with_rounded_corners
 
+log = get_logger("py2json")
+
+# Line breaks as ast counts them (form feeds do not end a line)
+LINE_BREAK = re.compile(rb"\r\n|\r|\n")
+
+
+class SourceIndex:
+    """
+    Byte offsets of the lines of a source, to slice the code of ast nodes out of it.
+    Replaces ast.get_source_segment(), which splits the whole source on every call.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        # ast column offsets count UTF-8 bytes
+        self.data = source.encode("utf-8")
+        self.line_starts: List[int] = [0]
+        self.line_starts.extend(match.end() for match in LINE_BREAK.finditer(self.data))
+
+    def offset(self, lineno: int, col_offset: int) -> int:
+        return self.line_starts[lineno - 1] + col_offset
+
+    def segment(self, node: ast.AST) -> Optional[str]:
+        """
+        Code of the node, like ast.get_source_segment(source, node)
+        """
+        try:
+            if node.end_lineno is None or node.end_col_offset is None:
+                return None
+            start = self.offset(node.lineno, node.col_offset)
+            end = self.offset(node.end_lineno, node.end_col_offset)
+        except AttributeError:
+            return None
+        return self.data[start:end].decode("utf-8")
+
+
 class Node:
     """
     Representation of global or local nodes.
     """
 
-    def __init__(self, name, tr,  misc):
+    def __init__(self, name, tr,  misc, titles):
         self.name = name
         self.transitions = tr
         self.misc = misc
+        self.titles = titles
 
     @classmethod
-    def parse_node(cls, flow_name, node_name, node, imports, source):
+    def parse_node(cls, flow_name, node_name, node, imports, index: SourceIndex):
         node_tuple = (flow_name, node_name)
         transitions = {}
+        titles = {}
         misc = ""
         for key, value in zip(node.keys, node.values):
             if key.id == 'TRANSITIONS':
@@ -42,8 +89,7 @@ class Node:
                     elif isinstance(tr_k, ast.Constant):  # Target node in the same flow
                         target_title = (flow_name, tr_k.value)
                     else:
-                        target_title = (flow_name, ast.get_source_segment(
-                            source, tr_k))
+                        target_title = (flow_name, index.segment(tr_k))
 
                     # Check type of values in Transitions dict
                     if isinstance(tr_v, ast.Constant):
@@ -59,10 +105,9 @@ class Node:
                         for arg in tr_v.args:
                             func_args.append(arg.value)
                         tr_description = f'{tr_v.func.value.id}.{tr_v.func.attr}({", ".join(func_args)})'"""
-                        tr_description = ast.get_source_segment(
-                            source, tr_v)
+                        tr_description = index.segment(tr_v)
                     elif isinstance(tr_v, ast.Attribute):
-                        tr_description = f"{ast.get_source_segment(source, tr_v.value)}.{tr_v.attr}"
+                        tr_description = f"{index.segment(tr_v.value)}.{tr_v.attr}"
                     elif hasattr(tr_v, "value"):
                         tr_description = tr_v.value
                     elif hasattr(tr_v, "id"):
@@ -70,6 +115,7 @@ class Node:
                     else:
                         tr_description = '""'
                     transitions[target_title] = tr_description
+                    titles[target_title] = ast_title(tr_description, tr_v, index.segment)[0]
             elif key.id == "MISC":
                 misc = []
                 if not isinstance(value, ast.Dict):
@@ -82,7 +128,7 @@ class Node:
                         if isinstance(element, ast.Constant):
                             misc.append(element.value)
 
-        return cls(node_tuple, transitions, misc)
+        return cls(node_tuple, transitions, misc, titles)
 
 
 class Flows:
@@ -90,34 +136,31 @@ class Flows:
     Representation of DFF flow.
     """
 
-    def __init__(self, source, tree):
+    def __init__(self, source, tree, flow=False):
         self.source = source
+        self.index = SourceIndex(source)
         self.tree = tree
         self.imports = {}
         self.flows_name = ""
         self.global_flow = {}
         self.local_flows = {}
-        self.keywords = [
-            "GLOBAL",
-            "LOCAL",
-            "TRANSITIONS",
-            "PROCESSING"
-            "RESPONSE",
-            "GLOBAL_TRANSITIONS"
-        ]
 
         # Initialize flows
-        self.flow = self.get_flow()
+        # The flow can be passed in if it was located already
+        self.flow = self.get_flow() if flow is False else flow
         self.get_imports()
         self.get_flows()
 
     def __str__(self):
-        return ast.get_source_segment(self.source, self.flow)
+        return "" if self.flow is None else self.index.segment(self.flow)
 
     def get_flows(self):
         """
-        Parse nodes within flows
+        Parse nodes within flows, there are none if the source has no plot
         """
+        if self.flow is None:
+            log.warning("no plot found")
+            return
         for child in ast.iter_child_nodes(self.flow):
             if isinstance(child, ast.Name):
                 self.flows_name = child.id
@@ -128,28 +171,20 @@ class Flows:
                     # print('FLOW Name:', flow_name)
                     if flow_name == "GLOBAL":
                         self.global_flow['GLOBAL'] = Node.parse_node(
-                            flow_name, flow_name, value, self.imports, self.source)
+                            flow_name, flow_name, value, self.imports, self.index)
                     else:
                         local_flow = {}
                         for node_key, node_val in zip(value.keys, value.values):
                             node_name = self.get_name(node_key)
                             local_flow[(flow_name, node_name)] = Node.parse_node(
-                                flow_name, node_name, node_val, self.imports, self.source)
+                                flow_name, node_name, node_val, self.imports, self.index)
                         self.local_flows[flow_name] = local_flow
 
-    def get_flow(self) -> ast.Assign:
+    def get_flow(self) -> Optional[ast.Assign]:
         """
         Detect line with flow and return its AST.
         """
-        for node in self.tree.body:
-            if isinstance(node, ast.Assign):
-                for child in ast.iter_child_nodes(node):
-                    if isinstance(child, ast.Dict):
-                        inner_data = ast.get_source_segment(self.source, child)
-                        for kword in self.keywords:
-                            if kword in inner_data:
-                                return node
-        return None
+        return locate_ast_flow(self.tree)
 
     def get_imports(self):
         """
@@ -187,7 +222,7 @@ def flow2graph(flow):
             node_data = {}
             edges = {}
             for path, description in node.transitions.items():
-                edges[path] = {"title": description, "id": node_id}
+                edges[path] = {"title": description, "id": node_id, "label": node.titles[path]}
                 node_id += 3 # Each edge will need three cells
             node_data['misc'] = node.misc
             node_data['edges'] = edges
@@ -229,23 +264,7 @@ def graph2json(graph):
                             continue
                 if target_id == "":
                     continue
-                parsed = cst.parse_expression(edge_data['title'])
-                cndlist = []
-                if isinstance(parsed, cst.Call) and len(parsed.args) > 0:
-                    mod = cst.parse_module(edge_data['title'])
-                    if isinstance(parsed.args[0].value, cst.List):
-                        cndlist = [mod.code_for_node(el.value) for el in parsed.args[0].value.elements]
-                        if isinstance(parsed.func, cst.Attribute):
-                            title = parsed.func.attr.value.capitalize()
-                        else:
-                            title = edge_data['title']
-                    elif "sf" in mod.code_for_node(parsed.func):
-                        title = mod.code_for_node(parsed.args[0])
-                        # title= edge_data['title']
-                    else:
-                        title = edge_data['title']
-                else:
-                    title = edge_data['title']
+                title = edge_data['label']
 
                 conn_node_id = len(nodes)
                 edges.append({
@@ -285,14 +304,41 @@ def graph2json(graph):
 
 
 def py2json(content):
-    tree = ast.parse(content)
-    flow = Flows(content, tree)
-    nodes = flow2graph(flow)
-    graph = graph2json(nodes)
-    # graph = layout(graph)
-    return graph
+    def build():
+        tree = parse_cache.tree(content)
+        flow_node = parse_cache.ast_flow(content)
+        with stage("flows"):
+            flow = Flows(content, tree, flow_node)
+        with stage("graph"):
+            nodes = flow2graph(flow)
+            graph = graph2json(nodes)
+        # graph = layout(graph)
+        return graph
+    return parse_cache.graph(content, "py2json", build, persist=True)
+
+
+@measured
+def handle(data):
+    """
+    Serve one request (JSON: { 'pycode': base64, 'session'?, 'version'?, 'layout'?, 'metrics'? }) and return the response.
+    With 'layout' every node has a position from the layout service (see graphviz.py).
+    With a session the graph has stable ids, and it is sent as a delta against the
+    version the client has (JSON: { 'version', 'graph' | 'delta' | 'unchanged' }).
+    """
+    py_code = text_field(data, 'pycode')
+    graph = py2json(py_code)
+    if data.get('layout'):
+        graph = parse_cache.graph(py_code, "py2json-layout", lambda: with_layout(graph))
+    count("nodes", len(graph['nodes']))
+    count("edges", len(graph['edges']))
+    if data.get('session') is None:
+        return {'graph': graph}
+    with stage("delta"):
+        return graph_sessions.update(data['session'], data.get('version'), graph)
 
 
-py_code = base64.b64decode(json.loads(sys.stdin.readline())['pycode']).decode('utf-8')
-data = py2json(py_code)
-json.dump({'graph': data}, sys.stdout)
+if __name__ == "__main__":
+    if "--framed" in sys.argv[1:]:
+        serve_once(handle)
+    else:
+        sys.stdout.write(dumps(handle(json.loads(sys.stdin.readline()))))
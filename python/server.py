@@ -0,0 +1,155 @@
+#!/usr/bin/env python3.9
+# Long-running conversion server.
+#
+# Reads one request per line from stdin and writes one response per line to stdout
+# (JSON: { 'id': ..., 'action': ..., 'payload': ... }). The payload of each action is
+# the same JSON object the one-off script of the same name reads from stdin, the
+# process stays alive so loaded modules and warm caches are kept between requests.
+#
+# With `--framed` requests and responses are binary frames instead (see framing.py),
+# source code and xml are then sent as raw UTF-8 rather than base64 in JSON.
+#
+# The converters are imported by the first request for them, so the first response
+# does not wait for libcst and lxml to load when it does not need them.
+import sys
+import bootstrap
+bootstrap.setup()
+
+import json
+import importlib
+import traceback
+from typing import Any, BinaryIO, Callable, Dict, Optional, TextIO
+
+import tracing
+from framing import dumps_response, read_frame, write_frame
+from cache import parse_cache
+
+Handler = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+log = tracing.get_logger("server")
+
+# Time to the first response (ms since the process started), and its action
+first_response: Optional[Dict[str, Any]] = None
+
+
+def converter(module: str, name: str = "handle") -> Handler:
+    """
+    Handler of a converter module, which is imported by the first request for it
+    """
+    def handler(data: Dict[str, Any]) -> Dict[str, Any]:
+        return getattr(importlib.import_module(module), name)(data)
+    return handler
+
+
+def cache(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Configure the parse cache (JSON: { 'max_entries'?, 'max_bytes'?, 'incremental'?, 'disk'? })
+    and return its counters. 'disk' is the directory of the disk cache or "off".
+    """
+    parse_cache.configure(
+        data.get("max_entries"), data.get("max_bytes"), data.get("incremental"), data.get("disk")
+    )
+    return {"cache": parse_cache.stats()}
+
+
+def trace(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Set the tracing level of the converters (JSON: { 'level': 'off' | 'debug' | ... })
+    """
+    tracing.configure(data.get("level", "off"))
+    return {}
+
+
+def startup(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Where the dependencies are imported from and the time to the first response
+    """
+    return {"deps": bootstrap.deps_path, "first_response": first_response, "modules": len(sys.modules)}
+
+
+ACTIONS: Dict[str, Handler] = {
+    "py2json": converter("py2json"),
+    "py2drawio": converter("py2drawio"),
+    "drawio2py": converter("drawio2py"),
+    "addsuggs": converter("addsuggs"),
+    "layout": converter("graphviz"),
+    "workspace": converter("workspace"),
+    "lookup": converter("workspace", "lookup"),
+    "cache": cache,
+    "trace": trace,
+    "startup": startup,
+}
+
+
+def serve_request(request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run a single request and wrap the result (or the error) into a response
+    """
+    response: Dict[str, Any] = {"id": request.get("id")}
+    action = request.get("action")
+    handler = ACTIONS.get(action)
+    if handler is None:
+        response["error"] = {"type": "UnknownAction", "message": f"Unknown action: {action}"}
+        return response
+    try:
+        response["payload"] = handler(request.get("payload") or {})
+    except Exception as e:
+        return failed(request, e)
+    return response
+
+
+def failed(request: Dict[str, Any], e: Exception) -> Dict[str, Any]:
+    traceback.print_exc(file=sys.stderr)
+    return {"id": request.get("id"), "error": {"type": type(e).__name__, "message": str(e)}}
+
+
+def responded(request: Dict[str, Any]):
+    global first_response
+    if first_response is None:
+        first_response = {"action": request.get("action"), "ms": bootstrap.elapsed_ms()}
+        log.info("first response (%s) after %.1f ms", first_response["action"], first_response["ms"])
+
+
+def serve(stdin: TextIO, stdout: TextIO):
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            request = {}
+            response = {"id": None, "error": {"type": "JSONDecodeError", "message": str(e)}}
+        else:
+            if request.get("action") == "exit":
+                break
+            response = serve_request(request)
+        # Streamed fields are generated while the response is encoded
+        try:
+            text = dumps_response(response)
+        except Exception as e:
+            text = dumps_response(failed(request, e))
+        stdout.write(text + "\n")
+        stdout.flush()
+        responded(request)
+
+
+def serve_framed(stdin: BinaryIO, stdout: BinaryIO):
+    while True:
+        request = read_frame(stdin)
+        if request is None or request.get("action") == "exit":
+            break
+        try:
+            write_frame(stdout, serve_request(request))
+        except Exception as e:
+            write_frame(stdout, failed(request, e))
+        responded(request)
+
+
+if __name__ == "__main__":
+    # Anything the converters print must not end up in the response stream
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    if "--framed" in sys.argv[1:]:
+        serve_framed(sys.stdin.buffer, out.buffer)
+    else:
+        serve(sys.stdin, out)
@@ -0,0 +1,127 @@
+# Regression test of the incremental parser: after any edit, reparsing incrementally
+# must give the same tree (and flow) as a full parse of the new source.
+#
+#   python -m unittest discover -s python/tests
+import sys, pathlib
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+import bootstrap
+bootstrap.setup()
+
+import random
+import unittest
+
+import libcst as cst
+
+from parse import find_flow
+from incremental import IncrementalParser
+
+FIXTURES = pathlib.Path(__file__).parent.parent.parent / "test" / "test-flows"
+EDITS_PER_FIXTURE = 60
+
+
+def positions(source: str, marker: str):
+    found = []
+    idx = source.find(marker)
+    while idx >= 0:
+        found.append(idx + len(marker))
+        idx = source.find(marker, idx + 1)
+    return found
+
+
+def random_edit(source: str, rng: random.Random, n: int) -> str:
+    """
+    An edit outside of the flow, inside a node, adding a node or a transition, or breaking the syntax
+    """
+    kind = rng.choice(["outside", "end", "node", "transition", "new_node", "rename", "break"])
+    if kind == "outside":
+        return f"x{n} = {n}\n" + source
+    if kind == "end":
+        return source + f"\ny{n} = {n}\n"
+    if kind == "node":
+        idx = rng.choice(positions(source, "RESPONSE: "))
+        return source[:idx] + f'"edit{n}" + ' + source[idx:]
+    if kind == "transition":
+        idx = rng.choice(positions(source, "TRANSITIONS: {"))
+        return source[:idx] + f'\n    "node{n}": cnd.true(), ' + source[idx:]
+    if kind == "new_node":
+        idx = rng.choice(positions(source, "\n    }"))
+        return source[:idx] + f',\n        "new{n}": {{TRANSITIONS: {{}}}}' + source[idx:]
+    if kind == "rename":
+        idx = rng.choice(positions(source, '"'))
+        return source[:idx] + "r" + source[idx:]
+    idx = rng.randrange(len(source))
+    return source[:idx] + "(((" + source[idx:]
+
+
+# Edits right after a closing brace, which a parsed dict expression would not keep
+BOUNDARY_EDITS = [" ", "  # note\n", "  # hi"]
+BOUNDARY_PLOT = """plot = {
+    "flow": {
+        "a": {TRANSITIONS: {"b": cnd.true()}},
+        "b": {TRANSITIONS: {}}
+    }
+}
+"""
+
+
+class IncrementalParserTest(unittest.TestCase):
+    def check_edit(self, parser: IncrementalParser, new: str):
+        try:
+            full = cst.parse_module(new)
+        except cst.ParserSyntaxError:
+            with self.assertRaises(cst.ParserSyntaxError):
+                parser.parse(new)
+            return False
+        module, flow = parser.parse(new)
+        self.assertEqual(module.code, new)
+        self.assertTrue(module.deep_equals(full))
+        full_flow = find_flow(full)
+        self.assertEqual(flow is None, full_flow is None)
+        if flow is not None:
+            self.assertTrue(flow.deep_equals(full_flow))
+        return True
+
+    def check_fixture(self, name: str, seed: int):
+        source = (FIXTURES / name).read_text()
+        rng = random.Random(seed)
+        parser = IncrementalParser()
+        parser.parse(source)
+        for n in range(EDITS_PER_FIXTURE):
+            new = random_edit(source, rng, n)
+            with self.subTest(fixture=name, edit=n):
+                if self.check_edit(parser, new):
+                    source = new
+        # The edits did not all fall back to a full parse
+        self.assertGreater(parser.stats()["outside"] + parser.stats()["node"], 0)
+
+    def test_food_skill(self):
+        self.check_fixture("food_skill.py", 1)
+
+    def test_test_flows(self):
+        self.check_fixture("test.py", 2)
+
+    def test_edits_after_closing_braces(self):
+        ends = {
+            "node": BOUNDARY_PLOT.index("}},") + 2,
+            "last node": BOUNDARY_PLOT.index("{}}\n") + 3,
+            "flow": BOUNDARY_PLOT.index("    }\n}") + 5,
+            "plot": BOUNDARY_PLOT.rindex("}") + 1,
+        }
+        for brace, idx in ends.items():
+            for text in BOUNDARY_EDITS:
+                with self.subTest(brace=brace, text=text):
+                    parser = IncrementalParser()
+                    parser.parse(BOUNDARY_PLOT)
+                    self.check_edit(parser, BOUNDARY_PLOT[:idx] + text + BOUNDARY_PLOT[idx:])
+
+    def test_edit_outside_of_flow_reuses_flow(self):
+        source = (FIXTURES / "food_skill.py").read_text()
+        parser = IncrementalParser()
+        _, flow = parser.parse(source)
+        module, new_flow = parser.parse("import os\n" + source)
+        self.assertIs(new_flow, flow)
+        self.assertTrue(module.deep_equals(cst.parse_module("import os\n" + source)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+# The viewer (ast) and the editing scripts (libcst) locate the same plot.
+#
+#   python -m unittest discover -s python/tests
+import sys, pathlib
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+import bootstrap
+bootstrap.setup()
+
+import ast
+import unittest
+
+import libcst as cst
+
+from locate import ast_items, cst_items, locate_ast_flow, locate_cst_flow, plot_size
+
+FIXTURES = pathlib.Path(__file__).parent.parent.parent / "test" / "test-flows"
+
+TERMINAL_NODES = """config = {"a": {"b": {}}}
+plot = {
+    "flow": {
+        "start": {RESPONSE: "hi", TRANSITIONS: {"end": cnd.true()}},
+        "end": {RESPONSE: "bye"},
+    },
+    "other": {"fallback": {RESPONSE: "oops"}},
+}
+"""
+
+
+class LocateTest(unittest.TestCase):
+    def check_same(self, source: str) -> str:
+        assign = locate_ast_flow(ast.parse(source))
+        module = cst.parse_module(source)
+        flow = locate_cst_flow(module)
+        self.assertEqual(assign is None, flow is None)
+        if flow is None:
+            return ""
+        code = module.code_for_node(flow)
+        self.assertEqual(ast.get_source_segment(source, assign.value), code)
+        return code
+
+    def test_fixtures(self):
+        for path in FIXTURES.glob("*.py"):
+            with self.subTest(path=path.name):
+                self.assertNotEqual(self.check_same(path.read_text()), "")
+
+    def test_nodes_without_transitions(self):
+        self.assertTrue(self.check_same(TERMINAL_NODES).startswith('{\n    "flow"'))
+
+    def test_plot_size(self):
+        flow = locate_cst_flow(cst.parse_module(TERMINAL_NODES))
+        self.assertEqual(plot_size(flow, cst_items), (3, 1))
+        assign = locate_ast_flow(ast.parse(TERMINAL_NODES))
+        self.assertEqual(plot_size(assign.value, ast_items), (3, 1))
+
+    def test_no_plot(self):
+        self.assertEqual(self.check_same('config = {"a": {"b": {}}}\nx = 1\n'), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
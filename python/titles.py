@@ -0,0 +1,66 @@
+import ast
+
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+
+from cache import LRUCache
+
+# Only cst_title() needs libcst, py2json gets by with ast
+if TYPE_CHECKING:
+    import libcst as cst
+
+# Distinct condition sources remembered, conditions repeat a lot within and across plots
+MAX_TITLES = 4096
+
+# Title of the condition cell and the conditions listed in it
+Title = Tuple[str, List[str]]
+
+_cst_titles: LRUCache[str, Title] = LRUCache(MAX_TITLES)
+_ast_titles: LRUCache[str, Title] = LRUCache(MAX_TITLES)
+
+
+def cst_title(desc: str, node: "cst.BaseExpression", module: "cst.Module") -> Title:
+    """
+    Title of a transition condition `desc`, read from its already parsed `node`.
+    A call with a list of conditions is titled by the function name,
+    a speech function condition by its argument.
+    """
+    title = _cst_titles.get(desc)
+    if title is None:
+        import libcst as cst
+
+        title = desc, []
+        if isinstance(node, cst.Call) and len(node.args) > 0:
+            code = module.code_for_node
+            if isinstance(node.args[0].value, cst.List):
+                cndlist = [code(el.value) for el in node.args[0].value.elements]
+                if isinstance(node.func, cst.Attribute):
+                    title = node.func.attr.value.capitalize(), cndlist
+                else:
+                    title = desc, cndlist
+            elif "sf" in code(node.func):
+                title = code(node.args[0]), []
+        _cst_titles.put(desc, title)
+    return title
+
+
+def ast_title(desc: str, node: ast.expr, segment: Callable[[ast.AST], Optional[str]]) -> Title:
+    """
+    Same as cst_title() for an ast node, `segment` returns the code of a node
+    """
+    title = _ast_titles.get(desc)
+    if title is None:
+        title = desc, []
+        args = sorted([*node.args, *node.keywords], key=lambda arg: (arg.lineno, arg.col_offset)) \
+            if isinstance(node, ast.Call) else []
+        if args:
+            first = args[0]
+            if isinstance(first, ast.List):
+                cndlist = [segment(el) for el in first.elts]
+                if isinstance(node.func, ast.Attribute):
+                    title = node.func.attr.capitalize(), cndlist
+                else:
+                    title = desc, cndlist
+            elif "sf" in segment(node.func):
+                title = segment(first), []
+        _ast_titles.put(desc, title)
+    return title
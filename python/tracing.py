@@ -0,0 +1,65 @@
+import os
+import sys
+import logging
+
+from typing import Any, Callable, Optional
+
+# More verbose than DEBUG: dumps of whole code blocks and collections
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+# "off" turns tracing off, warnings and errors are still reported
+LEVELS = {
+    "off": logging.WARNING,
+    "error": logging.ERROR,
+    "warning": logging.WARNING,
+    "info": logging.INFO,
+    "debug": logging.DEBUG,
+    "trace": TRACE,
+}
+
+ROOT = "dd_idde"
+root_logger = logging.getLogger(ROOT)
+root_logger.propagate = False
+
+
+class lazy:
+    """
+    Argument of a log message which is only computed when the message is formatted,
+    eg. `log.debug("code: %s", lazy(module.code_for_node, node))`
+    """
+    __slots__ = ("fn", "args")
+
+    def __init__(self, fn: Callable[..., Any], *args: Any):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Logger of a module, only warnings and errors are written unless tracing is configured.
+    Use `log.log(TRACE, ...)` for the TRACE level.
+    """
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def configure(level: Optional[str] = None):
+    """
+    Set the tracing level (see LEVELS), defaults to $DD_IDDE_TRACE or "off".
+    Messages are written to stderr.
+    """
+    if level is None:
+        level = os.environ.get("DD_IDDE_TRACE", "off")
+    if level not in LEVELS:
+        raise ValueError(f"Unknown tracing level: {level}")
+    if not root_logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter("%(name)s %(levelname)s: %(message)s"))
+        root_logger.addHandler(handler)
+    root_logger.setLevel(LEVELS[level])
+
+
+configure()
@@ -0,0 +1,36 @@
+import os
+
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, TypeVar
+
+# multiprocessing is only loaded when the pool is started
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Worker processes for CPU bound work (layouts, indexing), shared by the whole server
+max_workers = os.cpu_count() or 1
+
+_pool: Optional["ProcessPoolExecutor"] = None
+
+
+def get_pool() -> "ProcessPoolExecutor":
+    """
+    The process pool, started on first use
+    """
+    global _pool
+    if _pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+        _pool = ProcessPoolExecutor(max_workers=max_workers)
+    return _pool
+
+
+def parallel_map(fn: Callable[[T], R], items: Iterable[T], parallel: bool = True) -> Iterator[R]:
+    """
+    map() in the worker processes, or in this process if `parallel` is false
+    or there is only one CPU. `fn` and the items must be picklable.
+    """
+    if parallel and max_workers > 1:
+        return get_pool().map(fn, items)
+    return map(fn, items)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3.9
+# Workspace index of DFF plots: the flows, nodes and transitions of every script in
+# the workspace, so targets in other files can be looked up without parsing them again.
+#
+# As a script: indexes the directories given as arguments and writes the index
+# (JSON: { 'flows': { flow: [{ 'path', 'nodes': { node: [transition, ...] } }, ...] } }).
+import sys
+import bootstrap
+bootstrap.setup()
+
+import os
+import ast
+import json
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from locate import locate_ast_flow
+from tracing import get_logger
+from workers import parallel_map
+from metrics import count, measured, stage
+
+log = get_logger("workspace")
+
+# Directories which never hold the scripts of a workspace
+SKIP_DIRS = {"node_modules", "__pycache__", "venv", "site-packages", "dist", "build"}
+# Files are indexed in worker processes only when there are enough of them to pay for it
+PARALLEL_MIN_FILES = 8
+# Cheap check before a file is parsed, plots have transitions
+MARKER = b"TRANSITIONS"
+
+# (flow, node)
+NodeKey = Tuple[str, str]
+# Modification time (ns) and size of a file
+Stamp = Tuple[int, int]
+
+
+@dataclass
+class IndexedFile:
+    path: str
+    stamp: Stamp
+    # flow -> node -> target (flow, node) -> condition, empty if the file has no plot
+    flows: Dict[str, Dict[str, Dict[NodeKey, str]]] = field(default_factory=dict)
+
+
+def stamp(path: str) -> Optional[Stamp]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def skipped_dir(name: str) -> bool:
+    return name.startswith(".") or name in SKIP_DIRS
+
+
+def discover(root: str) -> Iterator[str]:
+    """
+    Python files under `root`, skipping hidden and tooling directories
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not skipped_dir(name)]
+        for name in filenames:
+            if name.endswith(".py"):
+                yield os.path.join(dirpath, name)
+
+
+def index_file(path: str) -> Optional[IndexedFile]:
+    """
+    Flows, nodes and transitions of one file, None if it cannot be read.
+    Runs in the worker processes.
+    """
+    from py2json import Flows
+
+    file_stamp = stamp(path)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    indexed = IndexedFile(path, file_stamp or (0, 0))
+    if MARKER not in data:
+        return indexed
+    try:
+        source = data.decode("utf-8")
+        tree = ast.parse(source)
+        flow = locate_ast_flow(tree)
+        if flow is None:
+            return indexed
+        flows = Flows(source, tree, flow)
+        for flow_name, nodes in flows.local_flows.items():
+            indexed.flows[flow_name] = {
+                node_name: dict(node.transitions)
+                for (_, node_name), node in nodes.items()
+                if node_name != "LOCAL"
+            }
+    except (SyntaxError, UnicodeDecodeError, ValueError, AttributeError) as e:
+        # Files which do not parse (yet) are indexed again once they change
+        log.debug("not indexed %s: %s", path, e)
+        indexed.flows = {}
+    return indexed
+
+
+def transitions_json(transitions: Dict[NodeKey, str]) -> List[Dict[str, str]]:
+    return [{"flow": flow, "node": node, "condition": cnd} for (flow, node), cnd in transitions.items()]
+
+
+class WorkspaceIndex:
+    """
+    Flows of all the files under the workspace roots.
+
+    Files are only parsed again when their modification time or size changes,
+    the lookup tables are updated per file, so a refresh after a change costs
+    about as much as indexing the changed files.
+    """
+
+    def __init__(self):
+        self.roots: List[str] = []
+        self.files: Dict[str, IndexedFile] = {}
+        # flow -> files defining it
+        self.definitions: Dict[str, Set[str]] = {}
+        # target (flow, node) -> files with transitions to it
+        self.references: Dict[NodeKey, Set[str]] = {}
+
+    def refresh(self, roots: Optional[Iterable[str]] = None) -> int:
+        """
+        Index the files under the roots which changed since the last refresh,
+        forget the ones which are gone. Returns the number of files parsed.
+        """
+        if roots is not None:
+            self.roots = [os.path.abspath(root) for root in roots]
+        found: Dict[str, Optional[Stamp]] = {}
+        for root in self.roots:
+            for path in discover(root):
+                found[path] = stamp(path)
+        for path in [path for path in self.files if path not in found]:
+            self._remove(path)
+        return self._index([
+            path for path, file_stamp in found.items()
+            if file_stamp is not None and (path not in self.files or self.files[path].stamp != file_stamp)
+        ])
+
+    def update(self, changed: Iterable[str] = (), removed: Iterable[str] = ()) -> int:
+        """
+        Apply the changes reported by a file watcher. Returns the number of files parsed.
+        """
+        for path in removed:
+            self._remove(os.path.abspath(path))
+        todo = []
+        for path in map(os.path.abspath, changed):
+            if not self.covers(path):
+                continue
+            file_stamp = stamp(path)
+            if file_stamp is None:
+                self._remove(path)
+            elif path not in self.files or self.files[path].stamp != file_stamp:
+                todo.append(path)
+        return self._index(todo)
+
+    def covers(self, path: str) -> bool:
+        """
+        Whether refresh() would index the file: a python file under a root, not in a skipped directory
+        """
+        if not path.endswith(".py"):
+            return False
+        for root in self.roots:
+            relative = os.path.relpath(path, root)
+            if not relative.startswith(os.pardir + os.sep):
+                return not any(skipped_dir(name) for name in relative.split(os.sep)[:-1])
+        return False
+
+    def lookup(self, flow: str, node: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Where a flow (or one of its nodes) is defined and which files have transitions to it
+        """
+        definitions = []
+        for path in sorted(self.definitions.get(flow, ())):
+            nodes = self.files[path].flows[flow]
+            if node is None:
+                definitions.append({
+                    "path": path,
+                    "nodes": {name: transitions_json(tr) for name, tr in nodes.items()},
+                })
+            elif node in nodes:
+                definitions.append({"path": path, "transitions": transitions_json(nodes[node])})
+        if node is None:
+            references = set().union(*(
+                paths for (target_flow, _), paths in self.references.items() if target_flow == flow
+            ))
+        else:
+            references = self.references.get((flow, node), set())
+        return {"definitions": definitions, "references": sorted(references)}
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"flows": {flow: self.lookup(flow)["definitions"] for flow in sorted(self.definitions)}}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "roots": self.roots,
+            "files": len(self.files),
+            "plots": sum(1 for indexed in self.files.values() if indexed.flows),
+            "flows": len(self.definitions),
+            "nodes": sum(len(nodes) for indexed in self.files.values() for nodes in indexed.flows.values()),
+        }
+
+    def _index(self, paths: List[str]) -> int:
+        if not paths:
+            return 0
+        parallel = len(paths) >= PARALLEL_MIN_FILES
+        count("files", len(paths))
+        log.debug("indexing %d files%s", len(paths), " in worker processes" if parallel else "")
+        with stage("index"):
+            for path, indexed in zip(paths, parallel_map(index_file, paths, parallel)):
+                self._remove(path)
+                if indexed is not None:
+                    self._add(indexed)
+        return len(paths)
+
+    def _add(self, indexed: IndexedFile):
+        self.files[indexed.path] = indexed
+        for flow, nodes in indexed.flows.items():
+            self.definitions.setdefault(flow, set()).add(indexed.path)
+            for transitions in nodes.values():
+                for target in transitions:
+                    self.references.setdefault(target, set()).add(indexed.path)
+
+    def _remove(self, path: str):
+        indexed = self.files.pop(path, None)
+        if indexed is None:
+            return
+        for flow, nodes in indexed.flows.items():
+            self._discard(self.definitions, flow, path)
+            for transitions in nodes.values():
+                for target in transitions:
+                    self._discard(self.references, target, path)
+
+    @staticmethod
+    def _discard(table: Dict[Any, Set[str]], key: Any, path: str):
+        paths = table.get(key)
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del table[key]
+
+
+workspace_index = WorkspaceIndex()
+
+
+@measured
+def handle(data):
+    """
+    Serve one request (JSON: { 'roots'?, 'changed'?, 'removed'? }) and return the index stats.
+    With 'roots' the workspace is (re)scanned, 'changed' and 'removed' are the paths
+    reported by the file watcher.
+    """
+    if data.get("roots") is not None:
+        indexed = workspace_index.refresh(data["roots"])
+    else:
+        indexed = workspace_index.update(data.get("changed") or (), data.get("removed") or ())
+    return {"indexed": indexed, **workspace_index.stats()}
+
+
+@measured
+def lookup(data):
+    """
+    Serve one request (JSON: { 'flow', 'node'? }) and return the definitions and references
+    """
+    return workspace_index.lookup(data["flow"], data.get("node"))
+
+
+if __name__ == "__main__":
+    workspace_index.refresh(sys.argv[1:] or ["."])
+    json.dump(workspace_index.to_json(), sys.stdout)
@@ -1,8 +1,7 @@
 import * as vscode from "vscode";
-import * as path from "path";
 import { TextDocument, WebviewPanel, CancellationToken } from "vscode";
-import { PythonShell } from "python-shell";
-import { Graph, ViewAction, ViewState } from "./types";
+import { GraphUpdate, TextEdit, ViewAction, ViewState } from "./types";
+import PythonServer, { Body } from "./PythonServer";
 
 function getPos(text: string, substring: string): {line: number, col: number} {
   var line = 1,
@@ -25,10 +24,17 @@ function getPos(text: string, substring: string): {line: number, col: number} {
   throw "Not found"
 }
 
+// Times the edits adding a node are computed while the document keeps changing
+const ADD_NODE_ATTEMPTS = 3;
+
 class GraphEditorProvider implements vscode.CustomTextEditorProvider {
   public static viewType = "deeppavlov.dd-idde-graph";
-  public static register(context: vscode.ExtensionContext): vscode.Disposable {
-    const provider = new GraphEditorProvider(context);
+  private static nextSession = 0;
+  public static register(
+    context: vscode.ExtensionContext,
+    server: PythonServer
+  ): vscode.Disposable {
+    const provider = new GraphEditorProvider(context, server);
     const providerRegistration = vscode.window.registerCustomEditorProvider(
       GraphEditorProvider.viewType,
       provider
@@ -37,7 +43,10 @@ class GraphEditorProvider implements vscode.CustomTextEditorProvider {
     return providerRegistration;
   }
 
-  constructor(private readonly context: vscode.ExtensionContext) {}
+  constructor(
+    private readonly context: vscode.ExtensionContext,
+    private readonly server: PythonServer
+  ) {}
 
   resolveCustomTextEditor(
     document: TextDocument,
@@ -49,15 +58,36 @@ class GraphEditorProvider implements vscode.CustomTextEditorProvider {
     };
     webviewPanel.webview.html = this.getHtmlForWebview(webviewPanel.webview);
 
-    const updateWebview = async () => {
-      const graph = await this.py2Graph(document.getText());
-      const newState: ViewState = {
-        graph,
-      };
+    // The python server sends the changes against the graph version the webview has
+    const session = `${GraphEditorProvider.nextSession++}:${document.uri}`;
+    let version: number | undefined;
+    let updating = Promise.resolve();
+
+    const sendUpdate = async (full: boolean) => {
+      const update = await this.py2Graph(
+        document.getText(),
+        session,
+        full ? undefined : version
+      );
+      version = update.version;
+      if (update.unchanged) {
+        return;
+      }
+      const newState: ViewState = update.graph
+        ? { graph: update.graph }
+        : { delta: update.delta };
       console.log("sending to webview", newState);
       webviewPanel.webview.postMessage(newState);
     };
 
+    // Updates run one after another, so each one is based on the previous version
+    const updateWebview = (full = false) => {
+      updating = updating
+        .then(() => sendUpdate(full))
+        .catch((err) => console.log("graph update failed", err));
+      return updating;
+    };
+
     const changeDocumentSubscription = vscode.workspace.onDidChangeTextDocument(
       (e) => {
         if (e.document.uri.toString() === document.uri.toString()) {
@@ -74,21 +104,38 @@ class GraphEditorProvider implements vscode.CustomTextEditorProvider {
       console.log("msg from webview", e);
       switch (e.type) {
         case "load":
-          updateWebview();
+          updateWebview(true);
           break;
         case "add":
-          const newPy = await this.addNode(
-            document.getText(),
+          const edits = await this.addNodeEdits(
+            document,
             e.payload.parentId,
             e.payload.parentFlow
           );
+          if (!edits) {
+            vscode.window.showWarningMessage(
+              "The node was not added: the document kept changing, try again."
+            );
+            break;
+          }
           const workspaceEdit = new vscode.WorkspaceEdit();
-          workspaceEdit.replace(
-            document.uri,
-            new vscode.Range(0, 0, document.lineCount, 0),
-            newPy
-          );
-          await vscode.workspace.applyEdit(workspaceEdit);
+          for (const edit of edits) {
+            workspaceEdit.replace(
+              document.uri,
+              new vscode.Range(
+                edit.range.start.line,
+                edit.range.start.character,
+                edit.range.end.line,
+                edit.range.end.character
+              ),
+              edit.newText
+            );
+          }
+          if (!(await vscode.workspace.applyEdit(workspaceEdit))) {
+            vscode.window.showWarningMessage("The node could not be added to the document.");
+            break;
+          }
+          const newPy = document.getText();
           updateWebview();
 
           for (let editor of vscode.window.visibleTextEditors) {
@@ -149,52 +196,65 @@ class GraphEditorProvider implements vscode.CustomTextEditorProvider {
 			</html>`;
   }
 
-  private async py2Graph(pythonCode: string): Promise<Graph> {
-    const b64Py = Buffer.from(pythonCode, "utf-8").toString("base64");
-    const result = (await this.runPythonScript("py2json", {
-      pycode: b64Py,
-    })) as { graph: Graph };
+  private async py2Graph(
+    pythonCode: string,
+    session: string,
+    version: number | undefined
+  ): Promise<GraphUpdate> {
+    const result = (await this.runPythonScript(
+      "py2json",
+      { session, version, layout: true },
+      { pycode: pythonCode }
+    )) as GraphUpdate;
     console.log("got graph from python", result);
-    return result.graph;
+    return result;
+  }
+
+  /*
+   * Edits adding a node, for the current version of the document. The edits are
+   * positions in the text they were computed from, so they are computed again
+   * if the document changed in the meantime. Null if it kept changing.
+   */
+  private async addNodeEdits(
+    document: TextDocument,
+    parentId: number,
+    parentFlow: string
+  ): Promise<TextEdit[] | null> {
+    for (let attempt = 0; attempt < ADD_NODE_ATTEMPTS; attempt++) {
+      const version = document.version;
+      const edits = await this.addNode(document.getText(), parentId, parentFlow);
+      if (document.version === version) {
+        return edits;
+      }
+    }
+    return null;
   }
 
   private async addNode(
     pythonCode: string,
     parentId: number,
     parentFlow: string
-  ): Promise<string> {
-    const b64Py = Buffer.from(pythonCode, "utf-8").toString("base64");
-    const result = (await this.runPythonScript("addsuggs", {
-      pyData: b64Py,
-      title: "'<Rename new node>'",
-      flow: parentFlow,
-      cnd: "lambda ctx, actor, *args, **kwargs: True",
-      parent: parentId,
-    })) as { pycode: string };
-    const code = Buffer.from(result.pycode, "base64").toString("utf-8");
-    return code;
+  ): Promise<TextEdit[]> {
+    const result = (await this.runPythonScript(
+      "addsuggs",
+      {
+        title: "'<Rename new node>'",
+        flow: parentFlow,
+        cnd: "lambda ctx, actor, *args, **kwargs: True",
+        parent: parentId,
+        edits: true,
+      },
+      { pyData: pythonCode }
+    )) as { edits: TextEdit[] };
+    return result.edits;
   }
 
-  private runPythonScript(script: string, input: object): Promise<object> {
-    return new Promise((resolve) => {
-      const pathToScript = vscode.Uri.file(
-        path.join(this.context.extensionPath, `python/${script}.py`)
-      ).fsPath;
-      console.log("running", pathToScript);
-      const shell = new PythonShell(pathToScript, { mode: "text" });
-      shell.send(JSON.stringify(input) + "\n");
-      console.log("sending to py", input);
-
-      shell.on("message", (msg) => resolve(JSON.parse(msg)));
-      shell.end((err) => {
-        console.log("script exited");
-        if (err) {
-          console.error(shell.stderr.read());
-          console.error(shell.stdout.read());
-          throw err;
-        }
-      });
-    });
+  private runPythonScript(
+    script: string,
+    input: object,
+    body: Body = {}
+  ): Promise<object> {
+    return this.server.request(script, input, body);
   }
 }
 
@@ -0,0 +1,214 @@
+import * as vscode from "vscode";
+import * as path from "path";
+import { PythonShell } from "python-shell";
+
+interface ServerResponse {
+  id: number;
+  payload?: { [field: string]: any };
+  error?: { type: string; message: string };
+  body?: [string, number][];
+  metrics?: object;
+}
+
+interface PendingRequest {
+  action: string;
+  resolve: (payload: object) => void;
+  reject: (err: Error) => void;
+}
+
+/*
+ * The metrics requested from the python server (see python/metrics.py),
+ * set by the `dd-idde.metrics` setting
+ */
+function metricsOption(): boolean | { memory: boolean } {
+  const setting = vscode.workspace
+    .getConfiguration("dd-idde")
+    .get<string>("metrics", "off");
+  if (setting === "memory") {
+    return { memory: true };
+  }
+  return setting === "timing";
+}
+
+/*
+ * Text fields sent as raw UTF-8 in the body of a frame instead of in the JSON header
+ */
+export type Body = { [field: string]: string };
+
+const PREFIX_LENGTH = 4;
+
+/*
+ * Encode a message as a frame (see python/framing.py): the length of the header,
+ * the JSON header listing the body fields and their byte length, then the body.
+ */
+function encodeFrame(message: object, body: Body): Buffer {
+  const fields = Object.entries(body).map(
+    ([name, text]) => [name, Buffer.from(text, "utf-8")] as [string, Buffer]
+  );
+  const header = Buffer.from(
+    JSON.stringify({
+      ...message,
+      body: fields.map(([name, data]) => [name, data.length]),
+    }),
+    "utf-8"
+  );
+  const prefix = Buffer.alloc(PREFIX_LENGTH);
+  prefix.writeUInt32BE(header.length, 0);
+  return Buffer.concat([prefix, header, ...fields.map(([, data]) => data)]);
+}
+
+/*
+ * Splits the stdout stream of the server into frames. Chunks are only copied
+ * together once a whole frame is available.
+ */
+class FrameReader {
+  private chunks: Buffer[] = [];
+  private available = 0;
+
+  constructor(private readonly onFrame: (message: ServerResponse) => void) {}
+
+  public push(chunk: Buffer) {
+    this.chunks.push(chunk);
+    this.available += chunk.length;
+    for (;;) {
+      const frame = this.nextFrame();
+      if (!frame) {
+        return;
+      }
+      this.onFrame(frame);
+    }
+  }
+
+  private nextFrame(): ServerResponse | null {
+    if (this.available < PREFIX_LENGTH) {
+      return null;
+    }
+    const headerLength = this.peek(PREFIX_LENGTH).readUInt32BE(0);
+    if (this.available < PREFIX_LENGTH + headerLength) {
+      return null;
+    }
+    const header = this.peek(PREFIX_LENGTH + headerLength);
+    const message: ServerResponse = JSON.parse(
+      header.toString("utf-8", PREFIX_LENGTH)
+    );
+    const fields = message.body || [];
+    const bodyLength = fields.reduce((sum, [, length]) => sum + length, 0);
+    const frameLength = PREFIX_LENGTH + headerLength + bodyLength;
+    if (this.available < frameLength) {
+      return null;
+    }
+    const frame = this.take(frameLength);
+    let offset = PREFIX_LENGTH + headerLength;
+    message.payload = message.payload || {};
+    for (const [name, length] of fields) {
+      message.payload[name] = frame.toString("utf-8", offset, offset + length);
+      offset += length;
+    }
+    delete message.body;
+    return message;
+  }
+
+  private peek(length: number): Buffer {
+    if (this.chunks[0].length < length) {
+      this.chunks = [Buffer.concat(this.chunks)];
+    }
+    return this.chunks[0];
+  }
+
+  private take(length: number): Buffer {
+    const data = this.peek(length);
+    const rest = data.subarray(length);
+    this.chunks[0] = rest;
+    if (rest.length === 0) {
+      this.chunks.shift();
+    }
+    this.available -= length;
+    return data.subarray(0, length);
+  }
+}
+
+/*
+ * Client for the long-running python conversion server (python/server.py).
+ * Requests are sent as binary frames and matched to responses by id.
+ */
+class PythonServer implements vscode.Disposable {
+  private shell: PythonShell | null = null;
+  private nextId = 0;
+  private pending = new Map<number, PendingRequest>();
+
+  constructor(private readonly extensionPath: string) {}
+
+  public request(action: string, payload: object, body: Body = {}): Promise<object> {
+    const shell = this.getShell();
+    const id = this.nextId++;
+    const metrics = metricsOption();
+    if (metrics) {
+      payload = { ...payload, metrics };
+    }
+    return new Promise((resolve, reject) => {
+      this.pending.set(id, { action, resolve, reject });
+      console.log("sending to py", action, payload);
+      shell.stdin.write(encodeFrame({ id, action, payload }, body));
+    });
+  }
+
+  public dispose() {
+    if (this.shell) {
+      this.shell.stdin.write(encodeFrame({ action: "exit" }, {}));
+      this.shell.end(() => undefined);
+      this.shell = null;
+    }
+  }
+
+  private getShell(): PythonShell {
+    if (this.shell) {
+      return this.shell;
+    }
+    const pathToScript = vscode.Uri.file(
+      path.join(this.extensionPath, "python/server.py")
+    ).fsPath;
+    console.log("starting", pathToScript);
+    const startedAt = Date.now();
+    let responded = false;
+    const shell = new PythonShell(pathToScript, {
+      mode: "binary",
+      args: ["--framed"],
+    });
+    const reader = new FrameReader((msg) => {
+      if (!responded) {
+        responded = true;
+        console.log(`python server first response after ${Date.now() - startedAt} ms`);
+      }
+      const request = this.pending.get(msg.id);
+      if (!request) {
+        return;
+      }
+      this.pending.delete(msg.id);
+      if (msg.error) {
+        request.reject(new Error(`${msg.error.type}: ${msg.error.message}`));
+        return;
+      }
+      if (msg.metrics) {
+        console.log("py metrics", request.action, JSON.stringify(msg.metrics));
+      }
+      request.resolve(msg.payload || {});
+    });
+    shell.stdout.on("data", (chunk: Buffer) => reader.push(chunk));
+    shell.stderr.on("data", (chunk: Buffer) => console.log("py:", chunk.toString()));
+    shell.on("close", () => {
+      console.log("python server exited");
+      if (this.shell === shell) {
+        this.shell = null;
+      }
+      // Requests that did not get an answer will not get one anymore
+      for (const request of this.pending.values()) {
+        request.reject(new Error("Python server exited"));
+      }
+      this.pending.clear();
+    });
+    this.shell = shell;
+    return shell;
+  }
+}
+
+export default PythonServer;
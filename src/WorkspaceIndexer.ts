@@ -0,0 +1,145 @@
+import * as vscode from "vscode";
+import * as path from "path";
+import PythonServer from "./PythonServer";
+
+// Changes reported by the watcher are sent together after this delay (ms)
+const DEBOUNCE = 300;
+// Directories which never hold the scripts of a workspace, as in python/workspace.py
+const SKIP_DIRS = new Set(["node_modules", "__pycache__", "venv", "site-packages", "dist", "build"]);
+// A transition target in another flow: ("flow", "node")
+const TARGET = /\(\s*(["'])([^"'\n]+)\1\s*,\s*(["'])([^"'\n]+)\3\s*\)/;
+
+interface Lookup {
+  definitions: { path: string }[];
+  references: string[];
+}
+
+/*
+ * Whether a file is outside of the workspace folders or in a directory the index skips
+ */
+function skipped(uri: vscode.Uri): boolean {
+  const folder = vscode.workspace.getWorkspaceFolder(uri);
+  if (!folder) {
+    return true;
+  }
+  const dirs = path.relative(folder.uri.fsPath, uri.fsPath).split(path.sep).slice(0, -1);
+  return dirs.some((dir) => dir.startsWith(".") || SKIP_DIRS.has(dir));
+}
+
+function escapeRegExp(text: string): string {
+  return text.replace(/[.*+?^${}()|[\]\\]/g, "\\$&");
+}
+
+/*
+ * Position of a node of a flow in a script: the first key naming the node after the flow key
+ */
+function nodePosition(document: vscode.TextDocument, flow: string, node: string): vscode.Position {
+  const text = document.getText();
+  const key = (name: string) => new RegExp(`(["'])${escapeRegExp(name)}\\1\\s*:`, "g");
+  const flowKey = key(flow);
+  const flowMatch = flowKey.exec(text);
+  const nodeKey = key(node);
+  nodeKey.lastIndex = flowMatch ? flowKey.lastIndex : 0;
+  const nodeMatch = nodeKey.exec(text) || flowMatch;
+  return document.positionAt(nodeMatch ? nodeMatch.index : 0);
+}
+
+/*
+ * Keeps the workspace index of the python server (python/workspace.py) up to date:
+ * the folders are indexed once, then only the python files the watcher reports.
+ * Go to definition on a target in another flow opens the scripts defining it.
+ */
+class WorkspaceIndexer implements vscode.Disposable, vscode.DefinitionProvider {
+  private watcher: vscode.FileSystemWatcher;
+  private changed = new Set<string>();
+  private removed = new Set<string>();
+  private timer: NodeJS.Timeout | null = null;
+  private disposables: vscode.Disposable[] = [];
+
+  constructor(private readonly server: PythonServer) {
+    this.watcher = vscode.workspace.createFileSystemWatcher("**/*.py");
+    this.disposables.push(
+      this.watcher,
+      this.watcher.onDidCreate((uri) => this.queue(uri, false)),
+      this.watcher.onDidChange((uri) => this.queue(uri, false)),
+      this.watcher.onDidDelete((uri) => this.queue(uri, true)),
+      vscode.workspace.onDidChangeWorkspaceFolders(() => this.refresh()),
+      vscode.languages.registerDefinitionProvider({ language: "python", scheme: "file" }, this)
+    );
+    this.refresh();
+  }
+
+  public lookup(flow: string, node?: string): Promise<Lookup> {
+    return this.server.request("lookup", { flow, node }) as Promise<Lookup>;
+  }
+
+  public async provideDefinition(
+    document: vscode.TextDocument,
+    position: vscode.Position
+  ): Promise<vscode.Location[]> {
+    const line = document.lineAt(position.line).text;
+    const target = new RegExp(TARGET.source, "g");
+    let match: RegExpExecArray | null;
+    while ((match = target.exec(line))) {
+      if (position.character < match.index || position.character > target.lastIndex) {
+        continue;
+      }
+      const [flow, node] = [match[2], match[4]];
+      const { definitions } = await this.lookup(flow, node);
+      return Promise.all(
+        definitions.map(async ({ path: file }) => {
+          const uri = vscode.Uri.file(file);
+          const script = await vscode.workspace.openTextDocument(uri);
+          return new vscode.Location(uri, nodePosition(script, flow, node));
+        })
+      );
+    }
+    return [];
+  }
+
+  public dispose() {
+    if (this.timer) {
+      clearTimeout(this.timer);
+    }
+    this.disposables.forEach((d) => d.dispose());
+  }
+
+  private refresh() {
+    const roots = (vscode.workspace.workspaceFolders || [])
+      .filter((folder) => folder.uri.scheme === "file")
+      .map((folder) => folder.uri.fsPath);
+    if (roots.length === 0) {
+      return;
+    }
+    this.server
+      .request("workspace", { roots })
+      .then((stats) => console.log("workspace indexed", stats))
+      .catch((err) => console.log("workspace index failed", err));
+  }
+
+  private queue(uri: vscode.Uri, removed: boolean) {
+    if (uri.scheme !== "file" || skipped(uri)) {
+      return;
+    }
+    const path = uri.fsPath;
+    (removed ? this.changed : this.removed).delete(path);
+    (removed ? this.removed : this.changed).add(path);
+    if (this.timer) {
+      clearTimeout(this.timer);
+    }
+    this.timer = setTimeout(() => this.flush(), DEBOUNCE);
+  }
+
+  private flush() {
+    this.timer = null;
+    const changed = [...this.changed];
+    const removed = [...this.removed];
+    this.changed.clear();
+    this.removed.clear();
+    this.server
+      .request("workspace", { changed, removed })
+      .catch((err) => console.log("workspace update failed", err));
+  }
+}
+
+export default WorkspaceIndexer;
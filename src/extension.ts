@@ -1,7 +1,12 @@
 import * as vscode from "vscode";
 
 import GraphEditorProvider from "./GraphEditorProvider";
+import PythonServer from "./PythonServer";
+import WorkspaceIndexer from "./WorkspaceIndexer";
 
 export function activate(context: vscode.ExtensionContext) {
-  context.subscriptions.push(GraphEditorProvider.register(context));
+  const server = new PythonServer(context.extensionPath);
+  context.subscriptions.push(server);
+  context.subscriptions.push(new WorkspaceIndexer(server));
+  context.subscriptions.push(GraphEditorProvider.register(context, server));
 }
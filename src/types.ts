@@ -1,26 +1,65 @@
+export interface GraphNode {
+  id: string;
+  type: string;
+  data: {
+    label: string;
+    flow: string;
+  };
+  // Set when the graph was laid out by the python server
+  position?: {
+    x: number;
+    y: number;
+  };
+}
+
+export interface GraphEdge {
+  id: string;
+  source: string;
+  target: string;
+}
+
 export interface Graph {
-  nodes: {
-    type: string;
-    data: {
-      label: string;
-      flow: string;
-    };
-    position: {
-      x: number;
-      y: number;
-    };
-  }[];
-  edges: {
-    source: number;
-    target: number;
-  }[];
+  nodes: GraphNode[];
+  edges: GraphEdge[];
+}
+
+/*
+ * Changes of the graph since the previous version, by node and edge id
+ */
+export interface GraphDelta {
+  nodes?: { added: GraphNode[]; removed: string[]; modified: GraphNode[] };
+  edges?: { added: GraphEdge[]; removed: string[]; modified: GraphEdge[] };
+}
+
+/*
+ * Response of py2json in a session: the full graph, the changes
+ * against the version the client had, or nothing if the graph is the same
+ */
+export interface GraphUpdate {
+  version: number;
+  graph?: Graph;
+  delta?: GraphDelta;
+  unchanged?: boolean;
+}
+
+/*
+ * A change of the python code computed by the python scripts,
+ * positions are zero-based like vscode.Position
+ */
+export interface TextEdit {
+  range: {
+    start: { line: number; character: number };
+    end: { line: number; character: number };
+  };
+  newText: string;
 }
 
 /*
- * The state passed to the webview in each message
+ * The message passed to the webview: a full graph or the changes to the last one
  */
 export interface ViewState {
-  graph: Graph;
+  graph?: Graph;
+  delta?: GraphDelta;
 }
 
 interface LoadAction {
@@ -1,7 +1,7 @@
 import { useEffect, useMemo, useState } from "react";
 import dagre from "dagre";
 import { Elements, Position, isNode } from "react-flow-renderer";
-import type { ViewState, ViewAction, Graph } from "../src/types";
+import type { ViewState, ViewAction, Graph, GraphDelta } from "../src/types";
 
 const vscode = acquireVsCodeApi();
 
@@ -9,11 +9,40 @@ export const sendAction = (a: ViewAction) => {
   vscode.postMessage(a);
 };
 
-export function useViewState(): ViewState | null {
-  const [state, setState] = useState<ViewState | null>(null);
+function applyChanges<T extends { id: string }>(
+  items: T[],
+  changes: { added: T[]; removed: string[]; modified: T[] } | undefined
+): T[] {
+  if (!changes) {
+    return items;
+  }
+  const removed = new Set(changes.removed);
+  const modified = new Map(changes.modified.map((item) => [item.id, item]));
+  return [
+    ...items
+      .filter((item) => !removed.has(item.id))
+      .map((item) => modified.get(item.id) || item),
+    ...changes.added,
+  ];
+}
+
+function applyDelta(graph: Graph, delta: GraphDelta): Graph {
+  return {
+    nodes: applyChanges(graph.nodes, delta.nodes),
+    edges: applyChanges(graph.edges, delta.edges),
+  };
+}
+
+export function useViewState(): { graph: Graph } | null {
+  const [state, setState] = useState<{ graph: Graph } | null>(null);
   useEffect(() => {
     const handler = (event: MessageEvent<ViewState>) => {
-      setState(event.data);
+      const { graph, delta } = event.data;
+      if (graph) {
+        setState({ graph });
+      } else if (delta) {
+        setState((prev) => prev && { graph: applyDelta(prev.graph, delta) });
+      }
     };
     window.addEventListener("message", handler);
     sendAction({ type: "load" });
@@ -31,17 +60,16 @@ const nodeHeight = 36;
 
 const getElements = (graph: Graph): Elements => {
   const elements: Elements = [
-    ...graph.nodes.map((node, idx) => ({
-      id: `${idx}`,
+    ...graph.nodes.map((node) => ({
+      id: node.id,
       data: node.data,
       type: node.type || "default",
-      // position: { ...node.position }
-      position: { x: 0, y: 0 },
+      position: node.position ? { ...node.position } : { x: 0, y: 0 },
     })),
     ...graph.edges.map((edge) => ({
-      id: `e${edge.source}-${edge.target}`,
-      source: `${edge.source}`,
-      target: `${edge.target}`,
+      id: edge.id,
+      source: edge.source,
+      target: edge.target,
     })),
   ];
 
@@ -51,6 +79,17 @@ const getElements = (graph: Graph): Elements => {
   //   if (!el.id.startsWith('e') && !el.position) console.warn("POS", el)
   //   })
 
+  // Laid out by the python server (see python/graphviz.py), dagre is the fallback
+  if (graph.nodes.every((node) => node.position)) {
+    return elements.map((el) => {
+      if (isNode(el)) {
+        el.targetPosition = Position.Left;
+        el.sourcePosition = Position.Right;
+      }
+      return el;
+    });
+  }
+
   const dagreGraph = new dagre.graphlib.Graph();
   dagreGraph.setDefaultEdgeLabel(() => ({}));
 
@@ -85,7 +124,7 @@ const getElements = (graph: Graph): Elements => {
   });
 };
 
-export function useGraphElements(state: ViewState | null): Elements {
+export function useGraphElements(state: { graph: Graph } | null): Elements {
   const elements = useMemo(
     () => (state ? getElements(state.graph) : []),
     [state?.graph]